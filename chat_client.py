@@ -2,18 +2,62 @@ from ttkthemes import ThemedTk
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
-import datetime, os, json, shutil, threading, time, base64, socket
+import datetime, os, json, shutil, threading, time, base64, socket, hashlib, uuid
 from io import BytesIO
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import chat_protocol
+from chat_store import AttachmentStore, JournalStore, SQLiteStore
+from chat_transfer import (ChunkReceiver, StatusCollector, BLOB_PREFIX, DIGEST_SIZE, blob_file_id, build_manifest,
+                           choose_chunk_size, manifest_file_id, parse_transfer_message, pop_text_payload,
+                           ranges_to_indices)
+from chat_media import ImageCache, ImageLoader, ThumbnailStore, photo_cost
 
 # 伺服器設定（測試用，請根據需求修改）
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 12345
 
-DATA_FILENAME = "messages.json"
+DATA_FILENAME = "messages.jsonl"         # 只追加的訊息日誌
+LEGACY_DATA_FILENAME = "messages.json"   # 舊版整份覆寫的紀錄，首次啟動時自動轉換
+DB_FILENAME = "messages.db"
+# 訊息儲存方式："journal"（JSON Lines 日誌）或 "sqlite"（有索引，適合大量歷史紀錄）
+STORAGE_BACKEND = "journal"
+# 日誌超過這個大小時改用 SQLite（首次會把日誌匯入），避免每次啟動都在記憶體中重建整份搜尋索引
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+
+# 搜尋：停止輸入多久後才查詢（毫秒），以及最多顯示幾筆結果
+SEARCH_DEBOUNCE_MS = 150
+SEARCH_RESULT_LIMIT = 50
+SEARCH_RETRY_MS = 500     # 搜尋索引還在建立時，隔多久再查一次
+
+# 訊息列表只為視窗附近的訊息建立元件：最多同時存在 RENDER_WINDOW 則，
+# 捲到距離邊緣 RENDER_EDGE（比例）以內時，再往該方向補 RENDER_PAGE 則並移除另一端
+RENDER_WINDOW = 60
+RENDER_PAGE = 20
+RENDER_EDGE = 0.1
+# 啟動時只載入最近的 HISTORY_PAGE_SIZE 則，捲到最上方時再向儲存區取更舊的一頁
+HISTORY_PAGE_SIZE = 200
 PROFILE_FILENAME = "profile.json"
 
 # 檔案大小門檻 (byte)，超過此值則採用分塊上傳（1MB）
 CHUNK_THRESHOLD = 1048576
+UPLOAD_PROGRESS_INTERVAL = 0.1  # 上傳進度最多每 0.1 秒更新一次畫面
+UPLOAD_STATUS_WAIT = 0.5        # 點對點模式下，送出 manifest 後等待各接收端回報缺少分塊的時間
+UPLOAD_SERVER_STATUS_WAIT = 10  # 伺服器附件庫只會有一個回覆，收到就繼續；這只是上限
+UPLOAD_MAX_ROUNDS = 5           # 補送缺塊的最多輪數
+UPLOAD_SYNC_TIMEOUT = 60        # 資料連線送完一輪後，等待伺服器處理完這些分塊的時間上限
+DATA_STREAMS = 2                # 大檔另開幾條資料連線平行上傳，聊天連線不受影響
+INBOUND_TICK_MS = 16            # 收到的訊息累積約一個畫面更新週期後一起處理
+INBOUND_BATCH_MAX = 500         # 每次最多處理幾筆，剩下的留到下一輪，避免畫面卡住
+OUTBOX_DRAIN_TIMEOUT = 5        # 關閉時最多等這麼久，讓已顯示為送出的訊息真的送出去
+# 收到的聊天訊息只保留這些欄位，不再把整段 JSON 當成文字存起來
+CHAT_FIELDS = ("text", "is_image", "sender_name", "sender_avatar_hash",
+               "file_hash", "file_name", "file_size", "file_chunked", "file_id")
+
+# 等待伺服器回覆 hello 的秒數，逾時視為舊版伺服器，改用文字格式
+HELLO_TIMEOUT = 2.0
 
 class ChatClientApp:
     def __init__(self, root):
@@ -26,10 +70,23 @@ class ChatClientApp:
             self.app_dir = os.path.dirname(os.path.abspath(__file__))
         except Exception:
             self.app_dir = os.getcwd()
+        self.attachments_dir = os.path.join(self.app_dir, "attachments")
+        self.attachments = AttachmentStore(self.attachments_dir)  # 以內容雜湊命名的附件庫
         self.data_path = os.path.join(self.app_dir, DATA_FILENAME)
+        legacy_path = os.path.join(self.app_dir, LEGACY_DATA_FILENAME)
+        if STORAGE_BACKEND == "sqlite" or (os.path.exists(self.data_path)
+                                           and os.path.getsize(self.data_path) > JOURNAL_MAX_BYTES):
+            self.data_path = os.path.join(self.app_dir, DB_FILENAME)
+            self.store = SQLiteStore(self.data_path, os.path.join(self.app_dir, DATA_FILENAME), legacy_path,
+                                     self.attachments)
+        else:
+            self.store = JournalStore(self.data_path, legacy_path, self.attachments)
         self.profile_path = os.path.join(self.app_dir, PROFILE_FILENAME)
-        self.attachments_dir = os.path.join(self.app_dir, "attachments")
-        os.makedirs(self.attachments_dir, exist_ok=True)
+        self.avatars_dir = os.path.join(self.app_dir, "avatars")  # 頭像以內容雜湊命名快取
+        os.makedirs(self.avatars_dir, exist_ok=True)
+        self.avatar_cache = {}       # 頭像雜湊 -> 原始 bytes
+        self.image_cache = ImageCache()  # 已解碼的頭像與縮圖
+        self.thumbnails = ThumbnailStore(os.path.join(self.app_dir, "thumbnails"))
         print("資料儲存路徑:", self.data_path)
 
         self.root.config(bg="#1f1f1f")
@@ -37,15 +94,30 @@ class ChatClientApp:
         self.message_font = ("Arial", 25)
         self.image_thumbnail_size = (300, 300)
         self.avatar_size = (50, 50)
+        # 影像在背景執行緒解碼，完成前先顯示空白佔位
+        self.image_loader = ImageLoader(self.root, self.image_cache)
+        self.avatar_placeholder = tk.PhotoImage(width=self.avatar_size[0], height=self.avatar_size[1])
 
         self.messages_data = []      # 儲存所有訊息
-        self.day_frames = {}         # 每天的訊息容器
-        self.last_header_info = {}   # 用來判斷是否顯示頭像與名稱 {date: (last_sender, count)}
-        self.ephemeral_map = {}      # 存放每則訊息對應的 UI 元件
+        self.message_seqs = []       # 與 messages_data 平行的遞增序號，刪除後仍可二分搜尋位置
+        self.seq_by_id = {}          # msg_id -> 序號，編輯、刪除、搜尋跳轉不必線性搜尋
+        self.first_seq = 0           # 往前補頁時由此往下編號，已有的序號不變
+        self.next_seq = 0
+        self.last_id_ms = 0          # new_message_id 用：同一毫秒內的訊息以計數器排序
+        self.id_counter = 0
+        self.day_frames = {}         # 每天的訊息容器（只包含目前有元件的日期）
+        self.ephemeral_map = {}      # 存放每則訊息對應的 UI 元件（只有目前建立的訊息）
+        self.render_start = 0        # 目前建立元件的訊息範圍 messages_data[render_start:render_end]
+        self.render_end = 0
+        self.render_check_pending = False
+        self.history_exhausted = False  # 儲存區中已沒有更舊的訊息
 
         self.attached_file_path = None
+        self.attached_file_hash = None
+        self.attached_file_name = None
         self.attached_file_preview = None
         self.uploaded_file_id = None  # 分塊上傳後的檔案識別
+        self.uploaded_file_name = None
         self.cancel_upload = False
         self.uploading = False       # 是否正在上傳大型檔案
 
@@ -56,9 +128,28 @@ class ChatClientApp:
         self.profile = self.load_profile()
         if not self.profile:
             self.setup_profile()
+        self.prepare_own_avatar()
+        self.client_id = self.ensure_client_id()
 
         # 建立與伺服器連線
         self.socket = None
+        self.send_lock = threading.Lock()  # 上傳執行緒與主執行緒共用 socket，避免訊框交錯
+        self.outbox = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")  # 聊天訊息依序在背景送出
+        self.binary_protocol = False
+        self.session_id = os.urandom(8).hex()  # 聊天與資料連線共用，伺服器據此不把自己的上傳轉回來
+        self.server_blobs = False          # 伺服器有附件庫：附件先上傳，訊息只帶雜湊
+        self.recv_buffer = bytearray()     # 協商期間多讀到的資料
+        self.pending_lines = []            # 協商完成前收到的文字訊息
+        self.inbound = deque()             # 接收執行緒放進來、Tk 執行緒定時整批取出的訊息
+        self.inbound_lock = threading.Lock()
+        self.inbound_scheduled = False
+        self.inbound_added = []            # 這一輪 drain_inbound 新增、尚未顯示的訊息
+        self.chunk_receiver = ChunkReceiver(self.attachments)  # 只在接收執行緒使用
+        self.received_files = {}           # 已接收完成的分塊檔案 file_id -> 檔案資訊
+        self.upload_statuses = StatusCollector()
+        self.downloading = set()           # 向伺服器下載中的附件雜湊
+        self.unavailable_blobs = set()     # 伺服器上也找不到的附件，不再重複要求
+        self.pending_saves = {}            # 下載完成後要另存的附件雜湊 -> 檔名
         self.connect_to_server()
 
         # -------------------- 上方捲動區 --------------------
@@ -66,7 +157,7 @@ class ChatClientApp:
         top_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
         self.canvas = tk.Canvas(top_frame, bg="#2b2b2b", highlightthickness=0)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.scrollbar = tk.Scrollbar(top_frame, orient="vertical", command=self.canvas.yview, bg="#2b2b2b")
+        self.scrollbar = tk.Scrollbar(top_frame, orient="vertical", command=self.on_scrollbar, bg="#2b2b2b")
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.canvas.configure(yscrollcommand=self.scrollbar.set)
         self.main_frame = tk.Frame(self.canvas, bg="#2b2b2b")
@@ -84,6 +175,8 @@ class ChatClientApp:
         self.search_entry.config(width=0)
         self.search_listbox = tk.Listbox(self.root, font=("Arial", 14), bg="#2b2b2b", fg="white")
         self.search_listbox.place_forget()
+        self.search_after_id = None
+        self.search_result_ids = []  # 搜尋清單每一列對應的 msg_id
         self.search_var.trace_add("write", self.on_search_var_changed)
         self.search_icon_btn = tk.Button(search_frame, text="🔍", font=("Arial", 18),
                                          bg="#3a3a3a", fg="white", activebackground="#2b2b2b",
@@ -155,6 +248,83 @@ class ChatClientApp:
         except Exception as e:
             print("儲存個人資料失敗:", e)
 
+    def ensure_client_id(self):
+        # 每個用戶端一個固定的識別碼，存在個人資料裡，讓不同用戶端產生的 msg_id 不會重複
+        if not self.profile:
+            return uuid.uuid4().hex[:12]
+        if not self.profile.get("client_id"):
+            self.profile["client_id"] = uuid.uuid4().hex[:12]
+            self.save_profile(self.profile)
+        return self.profile["client_id"]
+
+    def new_message_id(self):
+        # <毫秒時間>-<計數>-<用戶端>：依時間排序，同一毫秒以計數器區分，用戶端之間不會衝突
+        now_ms = int(time.time() * 1000)
+        if now_ms <= self.last_id_ms:
+            self.id_counter += 1
+        else:
+            self.last_id_ms = now_ms
+            self.id_counter = 0
+        return f"{self.last_id_ms:013d}-{self.id_counter:04d}-{self.client_id}"
+
+    def add_messages(self, msgs, prepend=False):
+        if prepend:
+            start = self.first_seq = self.first_seq - len(msgs)
+            self.messages_data[:0] = msgs
+            self.message_seqs[:0] = range(start, start + len(msgs))
+        else:
+            start = self.next_seq
+            self.next_seq += len(msgs)
+            self.messages_data.extend(msgs)
+            self.message_seqs.extend(range(start, start + len(msgs)))
+        for seq, msg_data in enumerate(msgs, start):
+            self.seq_by_id[msg_data["msg_id"]] = seq
+
+    def message_index(self, msg_id):
+        seq = self.seq_by_id.get(msg_id)
+        if seq is None:
+            return None
+        return bisect_left(self.message_seqs, seq)
+
+    def get_message(self, msg_id):
+        idx = self.message_index(msg_id)
+        return None if idx is None else self.messages_data[idx]
+
+    def prepare_own_avatar(self):
+        if not self.profile or not self.profile.get("avatar_data"):
+            return
+        try:
+            avatar_bytes = base64.b64decode(self.profile["avatar_data"])
+        except Exception as e:
+            print("頭像解碼失敗:", e)
+            return
+        avatar_hash = self.store_avatar(avatar_bytes)
+        if self.profile.get("avatar_hash") != avatar_hash:
+            self.profile["avatar_hash"] = avatar_hash
+            self.save_profile(self.profile)
+
+    def store_avatar(self, avatar_bytes):
+        avatar_hash = hashlib.sha256(avatar_bytes).hexdigest()
+        path = os.path.join(self.avatars_dir, avatar_hash)
+        if not os.path.exists(path):
+            try:
+                with open(path, "wb") as f:
+                    f.write(avatar_bytes)
+            except Exception as e:
+                print("頭像快取寫入失敗:", e)
+        self.avatar_cache[avatar_hash] = avatar_bytes
+        return avatar_hash
+
+    def get_avatar_bytes(self, avatar_hash):
+        avatar_bytes = self.avatar_cache.get(avatar_hash)
+        if avatar_bytes is None:
+            path = os.path.join(self.avatars_dir, avatar_hash)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    avatar_bytes = f.read()
+                self.avatar_cache[avatar_hash] = avatar_bytes
+        return avatar_bytes
+
     def setup_profile(self):
         dialog = tk.Toplevel(self.root)
         dialog.title("設定個人資料")
@@ -201,49 +371,431 @@ class ChatClientApp:
         except Exception as e:
             print("連線伺服器失敗:", e)
             self.socket = None
+            return
+        self.negotiate_protocol()
+        self.publish_profile()
+
+    def negotiate_protocol(self):
+        buffer = bytearray()
+        deadline = time.time() + HELLO_TIMEOUT
+        try:
+            self.socket.sendall(chat_protocol.hello_line(session=self.session_id))
+            while not self.binary_protocol:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.socket.settimeout(remaining)
+                data = self.socket.recv(16384)
+                if not data:
+                    break
+                buffer += data
+                while not self.binary_protocol:
+                    idx = buffer.find(b"\n")
+                    if idx < 0:
+                        break
+                    line = bytes(buffer[:idx])
+                    del buffer[:idx + 1]
+                    hello = chat_protocol.parse_hello(line)
+                    if hello:
+                        self.binary_protocol = True
+                        self.server_blobs = "blobs" in (hello.get("features") or [])
+                    elif line.strip():
+                        self.pending_lines.append(line.decode("utf-8", errors="replace").strip())
+        except socket.timeout:
+            pass
+        except Exception as e:
+            print("協定協商失敗:", e)
+        finally:
+            if self.socket:
+                self.socket.settimeout(None)
+        self.recv_buffer = buffer
+        print("使用二進位協定" if self.binary_protocol else "伺服器不支援二進位協定，使用文字格式")
+
+    def publish_profile(self):
+        # 每次連線只送一次頭像，之後的訊息只帶頭像雜湊
+        avatar_hash = self.profile.get("avatar_hash")
+        payload = self.get_avatar_bytes(avatar_hash) if avatar_hash else None
+        msg = {
+            "type": "profile",
+            "name": self.profile.get("name", "匿名"),
+            "avatar_hash": avatar_hash if payload else None
+        }
+        if payload:
+            msg["payload_field"] = "avatar_data"
+        self.send_network_message(msg, payload or b"")
 
-    def send_network_message(self, message):
+    def send_network_message(self, message, payload=b""):
         if self.socket:
             try:
-                self.socket.sendall((message + "\n").encode("utf-8"))
+                with self.send_lock:
+                    if self.binary_protocol:
+                        meta_bytes = chat_protocol.encode_meta(message)
+                        self.socket.sendall(chat_protocol.frame_header(meta_bytes, len(payload)))
+                        if payload:
+                            self.socket.sendall(payload)
+                    else:
+                        self.socket.sendall(chat_protocol.meta_to_text_line(message, payload))
             except Exception as e:
                 print("網路訊息傳送失敗:", e)
 
+    def open_data_streams(self):
+        # 另開只負責上傳的資料連線；伺服器不支援（沒回 hello）時回傳空列表，改走聊天連線
+        streams = []
+        if not self.binary_protocol:
+            return streams
+        for _ in range(DATA_STREAMS):
+            sock = None
+            try:
+                sock = socket.create_connection((SERVER_HOST, SERVER_PORT), timeout=HELLO_TIMEOUT)
+                sock.sendall(chat_protocol.hello_line(chat_protocol.ROLE_DATA, self.session_id))
+                reply = bytearray()
+                while b"\n" not in reply:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    reply += data
+                if not chat_protocol.is_hello_line(bytes(reply.split(b"\n", 1)[0])):
+                    sock.close()
+                    break
+                sock.settimeout(None)
+                streams.append(sock)
+            except OSError as e:
+                print("建立資料連線失敗:", e)
+                if sock:
+                    sock.close()
+                break
+        return streams
+
+    def send_data_frame(self, sock, message, payload):
+        meta_bytes = chat_protocol.encode_meta(message)
+        sock.sendall(chat_protocol.frame_header(meta_bytes, len(payload)))
+        sock.sendall(payload)
+
+    def sync_data_stream(self, sock, file_id):
+        # 等伺服器處理完這條資料連線上已送出的分塊；否則下一輪 manifest 會把還沒讀到的分塊回報成缺少
+        self.send_data_frame(sock, {"type": "file_sync", "file_id": file_id}, b"")
+        sock.settimeout(UPLOAD_SYNC_TIMEOUT)
+        buffer = bytearray()
+        try:
+            while True:
+                frames, consumed = chat_protocol.split_frames(buffer)
+                del buffer[:consumed]
+                for meta, _ in frames:
+                    msg, kind = parse_transfer_message(meta)
+                    if kind == "file_sync" and msg.get("file_id") == file_id:
+                        return
+                data = sock.recv(4096)
+                if not data:
+                    raise OSError("資料連線已關閉")
+                buffer += data
+        finally:
+            sock.settimeout(None)
+
     def receive_messages(self):
-        buffer = ""
+        for line in self.pending_lines:
+            try:
+                self.dispatch_line(line)
+            except Exception as e:
+                print("處理協商期間的訊息失敗:", e)
+        self.pending_lines = []
+        if self.binary_protocol:
+            self.receive_frames()
+        else:
+            self.receive_lines()
+        self.chunk_receiver.close()
+
+    def receive_lines(self):
+        buffer = self.recv_buffer
+        scan_pos = 0  # 已掃描過、確定沒有 \n 的位置，新資料進來只看新的部分
         while self.socket:
             try:
-                data = self.socket.recv(16384)
+                lines, scan_pos = chat_protocol.split_lines(buffer, scan_pos)
+                for raw in lines:
+                    line = raw.decode("utf-8", errors="replace").strip()
+                    if line:
+                        self.dispatch_line(line)
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                buffer += data
+            except Exception as e:
+                print("接收網路訊息失敗:", e)
+                break
+
+    def dispatch_line(self, line):
+        # 文字模式的一行：檔案傳輸訊息在接收執行緒處理，其餘交給 UI
+        msg, kind = parse_transfer_message(line)
+        if msg is not None:
+            self.handle_transfer_message(kind, msg, pop_text_payload(kind, msg))
+        else:
+            self.post_inbound(line)
+
+    def receive_frames(self):
+        buffer = self.recv_buffer
+        while self.socket:
+            try:
+                frames, consumed = chat_protocol.split_frames(buffer)
+                if consumed:
+                    del buffer[:consumed]
+                for meta, payload in frames:
+                    text = meta.decode("utf-8", errors="replace").strip()
+                    msg, kind = parse_transfer_message(text)
+                    if msg is not None:
+                        self.handle_transfer_message(kind, msg, payload)
+                    elif text:
+                        self.post_inbound(text, payload)
+                data = self.socket.recv(65536)
                 if not data:
                     break
-                buffer += data.decode("utf-8")
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if line.strip():
-                        self.root.after(0, self.send_received_message, line.strip())
+                buffer += data
             except Exception as e:
                 print("接收網路訊息失敗:", e)
                 break
 
-    def send_received_message(self, text):
+    def handle_transfer_message(self, kind, msg, payload):
+        if kind == "file_chunk":
+            self.on_chunk_received(msg, payload)
+        elif kind == "file_manifest":
+            # 告訴送出端這邊還缺哪些分塊，先前斷線留下的進度不必重送
+            try:
+                status = self.chunk_receiver.add_manifest(msg, payload)
+            except Exception as e:
+                print("建立接收檔案失敗:", e)
+                return
+            if status:
+                self.send_network_message(status)
+        elif kind == "file_status":
+            if msg.get("available") is False:
+                self.root.after(0, self.on_blob_unavailable, str(msg.get("file_hash") or ""))
+            else:
+                self.upload_statuses.add(msg)
+
+    def on_chunk_received(self, msg, data):
+        # 在接收執行緒直接寫入暫存檔，整個檔案到齊後才通知 UI
+        try:
+            info = self.chunk_receiver.add_chunk(msg, data)
+        except Exception as e:
+            print("分塊寫入失敗:", e)
+            self.chunk_receiver.discard(str(msg.get("file_id") or ""))
+            return
+        if info:
+            self.root.after(0, self.on_file_received, info)
+
+    def on_file_received(self, info):
+        if info["file_id"].startswith(BLOB_PREFIX):
+            self.on_blob_downloaded(info["file_id"][len(BLOB_PREFIX):], info)
+            return
+        self.received_files[info["file_id"]] = info
+        print(f"檔案接收完成: {info['file_name']} ({info['file_size']} bytes)")
+        # 訊息比檔案先到時，補上雜湊讓附件可以顯示
+        for msg_data in self.messages_data:
+            if msg_data.get("file_chunked") and msg_data.get("file_id") == info["file_id"] \
+                    and not msg_data.get("file_hash"):
+                msg_data["file_hash"] = info["file_hash"]
+                msg_data["file_size"] = info["file_size"]
+        self.refresh_attachment(info["file_hash"])
+
+    def request_blob(self, file_hash, file_name=None):
+        # 向伺服器下載附件；先前中斷的下載只要求缺少的分塊
+        if file_hash in self.downloading or not self.server_blobs:
+            return
+        self.downloading.add(file_hash)
+        request = {"type": "file_get", "file_hash": file_hash}
+        if file_name:
+            request["file_name"] = file_name
+        status = self.chunk_receiver.status(blob_file_id(file_hash))
+        if status:
+            request["missing"] = status["missing"]
+        self.send_network_message(request)
+
+    def on_blob_downloaded(self, file_hash, info):
+        self.downloading.discard(file_hash)
+        if info["file_hash"] != file_hash:
+            print("下載的附件雜湊不符:", file_hash)
+            return
+        self.refresh_attachment(file_hash)
+        save_name = self.pending_saves.pop(file_hash, None)
+        if save_name:
+            self.save_attachment_as(self.attachments.path_for(file_hash), save_name)
+
+    def on_blob_unavailable(self, file_hash):
+        self.downloading.discard(file_hash)
+        self.unavailable_blobs.add(file_hash)
+        self.refresh_attachment(file_hash)
+        if self.pending_saves.pop(file_hash, None):
+            messagebox.showerror("錯誤", "伺服器上找不到這個附件。")
+        print("伺服器上找不到附件:", file_hash)
+
+    def post_inbound(self, text, payload=b""):
+        # 接收執行緒呼叫：放進佇列，每個畫面週期最多排一次 drain_inbound
+        self.inbound.append((text, payload))
+        self.schedule_inbound_drain()
+
+    def schedule_inbound_drain(self):
+        with self.inbound_lock:
+            if self.inbound_scheduled:
+                return
+            self.inbound_scheduled = True
+        self.root.after(INBOUND_TICK_MS, self.drain_inbound)
+
+    def drain_inbound(self):
+        # 一批訊息只建立一次元件、捲動一次、寫入儲存區一次
+        with self.inbound_lock:
+            self.inbound_scheduled = False
+        self.inbound_added = []
+        for _ in range(INBOUND_BATCH_MAX):
+            try:
+                text, payload = self.inbound.popleft()
+            except IndexError:
+                break
+            try:
+                self.handle_network_message(text, payload)
+            except Exception as e:
+                print("處理網路訊息失敗:", e)
+        if self.inbound:
+            self.schedule_inbound_drain()
+        added, self.inbound_added = self.inbound_added, []
+        if added:
+            self.show_new_message(len(added))
+            self.scroll_to_bottom()
+            self.save_messages(added)
+
+    def handle_network_message(self, text, payload=b""):
+        # 每則訊息只解析一次 JSON，依 type 分派；聊天訊息只加進 messages_data，畫面與儲存由 drain_inbound 整批處理
+        msg = None
+        if text.startswith("{"):
+            try:
+                msg = json.loads(text)
+            except ValueError:
+                pass
+        if not isinstance(msg, dict):
+            # 不是 JSON 的純文字（舊版用戶端）
+            self.add_received_message({"text": text, "sender_name": "其他使用者"})
+            return
+        kind = msg.get("type", "chat")
+        if kind == "profile":
+            self.on_profile_received(msg, payload)
+        elif kind == "chat":
+            self.add_received_message(msg, payload)
+        elif kind == "edit":
+            self.on_remote_edit(msg)
+        elif kind == "delete":
+            self.on_remote_delete(msg)
+        else:
+            print("忽略未知的訊息類型:", kind)
+
+    def on_profile_received(self, msg, payload):
+        try:
+            avatar_bytes = payload or base64.b64decode(msg.get("avatar_data") or "")
+        except Exception as e:
+            print("頭像解碼失敗:", e)
+            return
+        if not avatar_bytes:
+            return
+        avatar_hash = self.store_avatar(avatar_bytes)
+        if avatar_hash != msg.get("avatar_hash"):
+            print("頭像雜湊不符:", msg.get("name"))
+
+    def add_received_message(self, msg, payload=b""):
         now = datetime.datetime.now()
         date_str = now.strftime("%Y/%m/%d")
         time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
         msg_data = {
-            "msg_id": msg_id,
-            "text": text,
+            "msg_id": None,
+            "text": "",
             "date": date_str,
             "timestamp": time_str,
             "file_path": None,
             "is_image": False,
-            "sender_name": "其他使用者",
-            "sender_avatar": ""
+            "sender_name": "匿名",
+            "sender_avatar_hash": None
         }
-        self.create_message_ui(msg_data)
-        self.messages_data.append(msg_data)
-        self.scroll_to_bottom()
-        self.save_data()
+        for key in CHAT_FIELDS:
+            if msg.get(key) is not None:
+                msg_data[key] = msg[key]
+        msg_data["text"] = str(msg_data["text"])
+        if not msg_data["sender_avatar_hash"] and msg.get("sender_avatar"):
+            # 舊版用戶端每則訊息都內嵌 base64 頭像：收進頭像快取，紀錄只留雜湊
+            try:
+                msg_data["sender_avatar_hash"] = self.store_avatar(base64.b64decode(msg["sender_avatar"]))
+            except Exception as e:
+                print("頭像解碼失敗:", e)
+        remote_id = msg.get("msg_id")
+        if isinstance(remote_id, str) and remote_id not in self.seq_by_id:
+            # 新版用戶端的 msg_id 全域唯一，直接沿用，編輯／刪除可以直接查表
+            msg_data["msg_id"] = remote_id
+        else:
+            msg_data["msg_id"] = self.new_message_id()
+            if remote_id is not None:
+                # 舊版用戶端的流水號只在對方那邊有意義，留著給編輯／刪除比對
+                msg_data["remote_id"] = remote_id
+        if payload or msg.get("file_data"):
+            # 內嵌的附件收進附件庫，紀錄只留雜湊
+            try:
+                data = payload or base64.b64decode(msg["file_data"])
+                msg_data["file_hash"] = self.attachments.put_bytes(data)
+                msg_data["file_size"] = len(data)
+            except Exception as e:
+                print("附件儲存失敗:", e)
+        elif msg_data.get("file_chunked") and not msg_data.get("file_hash"):
+            info = self.received_files.get(msg_data.get("file_id"))
+            if info:
+                msg_data["file_hash"] = info["file_hash"]
+                msg_data["file_size"] = info["file_size"]
+        self.add_messages([msg_data])
+        self.inbound_added.append(msg_data)
+
+    def find_remote_message(self, msg):
+        remote_id = msg.get("msg_id")
+        sender = msg.get("sender_name", "匿名")
+        if isinstance(remote_id, str):
+            msg_data = self.get_message(remote_id)
+            if msg_data is not None and "remote_id" not in msg_data \
+                    and msg_data.get("sender_name", "匿名") == sender:
+                return msg_data
+            return None
+        for msg_data in reversed(self.messages_data):
+            if msg_data.get("remote_id") == remote_id and msg_data.get("sender_name", "匿名") == sender:
+                return msg_data
+        return None
+
+    def on_remote_edit(self, msg):
+        msg_data = self.find_remote_message(msg)
+        if msg_data is None:
+            return
+        msg_data["text"] = str(msg.get("text", ""))
+        ep = self.ephemeral_map.get(msg_data["msg_id"])
+        if ep and ep.get("text_frame"):
+            for child in ep["text_frame"].winfo_children():
+                child.destroy()
+            self.fill_text_frame(ep["text_frame"], msg_data["text"])
+        self.save_edit(msg_data["msg_id"], msg_data["text"])
+
+    def on_remote_delete(self, msg):
+        msg_data = self.find_remote_message(msg)
+        if msg_data is not None:
+            self.remove_message(msg_data["msg_id"])
+
+    def is_own_message(self, msg_data):
+        # 自己送出的訊息才把編輯／刪除同步給其他人；舊版用戶端傳來的訊息編號是這邊產生的，要先排除，
+        # 舊紀錄（原本是數字編號）只能比對名字
+        if "remote_id" in msg_data:
+            return False
+        if "legacy_id" in msg_data:
+            return msg_data.get("sender_name") == self.profile.get("name", "匿名")
+        return msg_data["msg_id"].endswith("-" + self.client_id)
+
+    def network_id(self, msg_data):
+        # 舊紀錄在其他用戶那邊是以原本的數字編號記住的
+        return msg_data.get("legacy_id", msg_data["msg_id"])
+
+    def send_edit(self, msg_data):
+        self.outbox.submit(self.send_network_message, {"type": "edit", "msg_id": self.network_id(msg_data),
+                                                       "text": msg_data["text"], "sender_name": msg_data["sender_name"]})
+
+    def send_delete(self, msg_data):
+        self.outbox.submit(self.send_network_message, {"type": "delete", "msg_id": self.network_id(msg_data),
+                                                       "sender_name": msg_data["sender_name"]})
 
     def on_frame_configure(self):
         self.canvas.config(scrollregion=self.canvas.bbox("all"))
@@ -251,6 +803,131 @@ class ChatClientApp:
     def on_mousewheel(self, event):
         direction = -1 * int(event.delta // 120)
         self.canvas.yview_scroll(direction, "units")
+        self.schedule_render_check()
+
+    def on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self.schedule_render_check()
+
+    def schedule_render_check(self):
+        if not self.render_check_pending:
+            self.render_check_pending = True
+            self.root.after_idle(self.check_render_window)
+
+    def check_render_window(self):
+        self.render_check_pending = False
+        top, bottom = self.canvas.yview()
+        if top <= RENDER_EDGE and (self.render_start > 0 or self.load_older_messages()):
+            self.shift_render_window(-1)
+        elif bottom >= 1 - RENDER_EDGE and self.render_end < len(self.messages_data):
+            self.shift_render_window(1)
+
+    def shift_render_window(self, direction):
+        # 以一則前後都會保留的訊息當錨點，補上/移除訊息後把畫面移回原位，使用者不會感覺跳動
+        anchor_idx = self.render_start if direction < 0 else self.render_end - 1
+        anchor = self.ephemeral_map.get(self.messages_data[anchor_idx]["msg_id"])
+        before = self.get_container_offset_in_canvas(anchor["container"]) if anchor else None
+        if direction < 0:
+            new_start = max(0, self.render_start - RENDER_PAGE)
+            self.render_range(new_start, self.render_start, at_top=True)
+            self.render_start = new_start
+            while self.render_end - self.render_start > RENDER_WINDOW:
+                self.render_end -= 1
+                self.remove_message_ui(self.messages_data[self.render_end])
+        else:
+            new_end = min(len(self.messages_data), self.render_end + RENDER_PAGE)
+            self.render_range(self.render_end, new_end)
+            self.render_end = new_end
+            while self.render_end - self.render_start > RENDER_WINDOW:
+                self.remove_message_ui(self.messages_data[self.render_start])
+                self.render_start += 1
+        self.root.update_idletasks()
+        self.on_frame_configure()
+        if anchor:
+            self.adjust_canvas_scroll(self.get_container_offset_in_canvas(anchor["container"]) - before)
+
+    def load_older_messages(self):
+        # 在 messages_data 前面補上一頁更舊的訊息；回傳是否有載入
+        if self.history_exhausted:
+            return False
+        try:
+            older = self.store.load_older(HISTORY_PAGE_SIZE)
+        except Exception as e:
+            print("讀取舊紀錄失敗:", e)
+            older = []
+        if not older:
+            self.history_exhausted = True
+            return False
+        self.add_messages(older, prepend=True)
+        self.render_start += len(older)
+        self.render_end += len(older)
+        return True
+
+    def render_window(self, start):
+        # 清空目前的元件，改為建立 messages_data[start:start + RENDER_WINDOW]
+        for day_frame in self.day_frames.values():
+            day_frame.destroy()
+        self.day_frames = {}
+        self.ephemeral_map = {}
+        start = max(0, min(start, len(self.messages_data) - RENDER_WINDOW))
+        self.render_start = start
+        self.render_end = min(len(self.messages_data), start + RENDER_WINDOW)
+        self.render_range(self.render_start, self.render_end)
+
+    def render_range(self, start, end, at_top=False):
+        headers = self.header_flags(start, end)
+        indices = range(start, end)
+        if at_top:
+            # 由新到舊逐一插到最前面，最後順序仍是由舊到新
+            for i in reversed(indices):
+                self.create_message_ui(self.messages_data[i], headers[i - start], at_top=True)
+        else:
+            for i in indices:
+                self.create_message_ui(self.messages_data[i], headers[i - start])
+
+    def header_flags(self, start, end):
+        # 同一天同一人連續發言時，每 7 則才顯示一次頭像與名稱；由資料推算，與建立順序無關
+        flags = []
+        count = 0
+        if start < end:
+            first = self.messages_data[start]
+            i = start - 1
+            while i >= 0 and self.is_same_run(self.messages_data[i], first):
+                count += 1
+                i -= 1
+        for i in range(start, end):
+            if i > start and not self.is_same_run(self.messages_data[i - 1], self.messages_data[i]):
+                count = 0
+            count += 1
+            flags.append(count % 7 == 1)
+        return flags
+
+    def is_same_run(self, prev, msg):
+        return (prev["date"] == msg["date"]
+                and prev.get("sender_name", "匿名") == msg.get("sender_name", "匿名"))
+
+    def show_new_message(self, count=1):
+        # 新訊息一定在最後；視窗停在最新處時只補上新的幾則，否則直接跳到最新的範圍
+        total = len(self.messages_data)
+        first = total - count
+        if self.render_end == first and count <= RENDER_WINDOW:
+            self.render_range(first, total)
+            self.render_end = total
+            while self.render_end - self.render_start > RENDER_WINDOW:
+                self.remove_message_ui(self.messages_data[self.render_start])
+                self.render_start += 1
+        else:
+            self.render_window(len(self.messages_data))
+
+    def remove_message_ui(self, msg_data):
+        ep = self.ephemeral_map.pop(msg_data["msg_id"], None)
+        if ep:
+            ep["container"].destroy()
+        day_frame = self.day_frames.get(msg_data["date"])
+        # 只剩日期標籤時整個日期區塊一起移除
+        if day_frame and len(day_frame.winfo_children()) <= 1:
+            day_frame.destroy()
+            del self.day_frames[msg_data["date"]]
 
     def scroll_to_bottom(self):
         self.root.update_idletasks()
@@ -281,114 +958,112 @@ class ChatClientApp:
         if not text and not self.attached_file_path and not self.uploaded_file_id:
             print("無法送出：文字空且無檔案")
             return
-        message = self.prepare_message(text)
+        msg_data = self.build_message(text)
         # Debug: 印出準備送出的訊息
-        print("準備送出訊息:", message)
-        self.send_network_message(message)
-        self.send_message(text)
+        print("準備送出訊息:", msg_data)
+        inline_path = None
+        if msg_data.get("file_hash") and not self.server_blobs:
+            # 伺服器沒有附件庫：附件內容跟著訊息送，讀檔交給背景執行緒
+            inline_path = self.attached_file_path
+        self.outbox.submit(self.send_chat_message, dict(msg_data, type="chat"), inline_path)
+        self.add_messages([msg_data])
+        self.show_new_message()
+        self.entry_var.set("")
+        self.preview_label.pack_forget()
+        self.preview_label.config(text="", image="")
+        self.attached_file_path = None
+        self.attached_file_hash = None
+        self.attached_file_name = None
+        self.attached_file_preview = None
+        self.uploaded_file_id = None
+        self.uploaded_file_name = None
+        self.scroll_to_bottom()
+        self.save_message(msg_data)
 
-    def prepare_message(self, text):
+    def build_message(self, text):
+        # 送出與本機紀錄共用同一份資料；附件只記錄雜湊
         now = datetime.datetime.now()
         date_str = now.strftime("%Y/%m/%d")
         time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
         msg_data = {
-            "msg_id": msg_id,
+            "msg_id": self.new_message_id(),
             "text": text,
             "date": date_str,
             "timestamp": time_str,
             "file_path": None,
             "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
+            "sender_name": self.profile.get("name", "匿名"),
+            "sender_avatar_hash": self.profile.get("avatar_hash")
         }
         if self.uploaded_file_id:
             msg_data["file_chunked"] = True
             msg_data["file_id"] = self.uploaded_file_id
+            msg_data["file_name"] = self.uploaded_file_name
         elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
+            msg_data["file_hash"] = self.attached_file_hash
+            msg_data["file_name"] = self.attached_file_name
+            msg_data["file_size"] = os.path.getsize(self.attached_file_path)
+            if self.is_image_file(self.attached_file_name):
                 msg_data["is_image"] = True
-            try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
-            except Exception as e:
-                print("檔案編碼失敗:", e)
-        return json.dumps(msg_data, ensure_ascii=False)
+        return msg_data
 
-    def send_message(self, text):
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y/%m/%d")
-        time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
-        msg_data = {
-            "msg_id": msg_id,
-            "text": text,
-            "date": date_str,
-            "timestamp": time_str,
-            "file_path": None,
-            "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
-        }
-        if self.uploaded_file_id:
-            msg_data["file_chunked"] = True
-            msg_data["file_id"] = self.uploaded_file_id
-        elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
-                msg_data["is_image"] = True
+    def send_chat_message(self, message, inline_path=None):
+        # 在 outbox 執行緒執行，訊息依送出順序傳出
+        payload = b""
+        if inline_path:
             try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
+                with open(inline_path, "rb") as f:
+                    payload = f.read()
+                # 附件以原始 bytes 放在訊框 payload，文字模式才會轉回 file_data 的 base64
+                message["payload_field"] = "file_data"
             except Exception as e:
-                print("檔案編碼失敗:", e)
-        self.create_message_ui(msg_data)
-        self.messages_data.append(msg_data)
-        self.entry_var.set("")
-        self.preview_label.pack_forget()
-        self.preview_label.config(text="", image="")
-        self.attached_file_path = None
-        self.attached_file_preview = None
-        self.uploaded_file_id = None
-        self.scroll_to_bottom()
-        self.save_data()
+                print("檔案讀取失敗:", e)
+        self.send_network_message(message, payload)
 
     def on_close(self):
-        self.save_data()
+        self.image_loader.shutdown()
+        # outbox 依序執行，最後排入的空工作完成就代表前面的訊息都送完了；連線卡住時不無限等待
+        try:
+            self.outbox.submit(lambda: None).result(timeout=OUTBOX_DRAIN_TIMEOUT)
+        except Exception:
+            print("關閉前仍有訊息未送出")
+        self.outbox.shutdown(wait=False)
+        self.store.close()
         if self.socket:
             self.socket.close()
         self.root.destroy()
 
     def load_data(self):
-        self.last_header_info = {}
-        if os.path.exists(self.data_path):
-            try:
-                with open(self.data_path, "r", encoding="utf-8") as f:
-                    saved_msgs = json.load(f)
-            except Exception as e:
-                print("讀取舊紀錄失敗:", e)
-                return
-            for m in saved_msgs:
-                self.create_message_ui(m)
-            self.messages_data = saved_msgs
+        try:
+            saved_msgs = self.store.load_recent(HISTORY_PAGE_SIZE)
+        except Exception as e:
+            print("讀取舊紀錄失敗:", e)
+            return
+        self.add_messages(saved_msgs)
+        self.render_window(len(saved_msgs))
         self.scroll_to_bottom()
 
-    def save_data(self):
+    def save_message(self, msg_data):
+        try:
+            self.store.append(msg_data)
+        except Exception as e:
+            print("儲存資料失敗:", e)
+
+    def save_messages(self, msgs):
+        try:
+            self.store.append_many(msgs)
+        except Exception as e:
+            print("儲存資料失敗:", e)
+
+    def save_edit(self, msg_id, text):
+        try:
+            self.store.update_text(msg_id, text)
+        except Exception as e:
+            print("儲存資料失敗:", e)
+
+    def save_delete(self, msg_id):
         try:
-            with open(self.data_path, "w", encoding="utf-8") as f:
-                json.dump(self.messages_data, f, ensure_ascii=False, indent=2)
-            print("已儲存資料至", self.data_path)
+            self.store.delete(msg_id)
         except Exception as e:
             print("儲存資料失敗:", e)
 
@@ -399,44 +1074,50 @@ class ChatClientApp:
         # 所有檔案（包含影片）皆走附件上傳流程
         filesize = os.path.getsize(orig_path)
         if filesize > CHUNK_THRESHOLD:
-            self.cancel_upload = False
-            self.uploaded_file_id = os.path.basename(orig_path)
-            self.uploading = True
-            threading.Thread(target=self.send_file_in_chunks, args=(orig_path,), daemon=True).start()
+            self.uploaded_file_id = None
+            self.uploaded_file_name = None
+            self.start_upload(orig_path, os.path.basename(orig_path))
             messagebox.showinfo("上傳中", "超大檔案正在分塊上傳中，請稍候...")
         else:
             base_name = os.path.basename(orig_path)
-            new_path = os.path.join(self.attachments_dir, base_name)
-            if not self.copy_file_with_progress(orig_path, new_path):
+            file_hash = self.copy_file_with_progress(orig_path)
+            if not file_hash:
                 return
-            self.attached_file_path = new_path
-            if self.is_image_file(new_path):
-                try:
-                    img = Image.open(new_path)
-                    img.thumbnail(self.image_thumbnail_size)
-                    preview_img = ImageTk.PhotoImage(img)
-                    self.attached_file_preview = preview_img
-                    self.preview_label.config(image=preview_img, text="")
-                except:
-                    self.preview_label.config(text=base_name, image="")
+            if self.server_blobs:
+                # 附件先上傳到伺服器附件庫，完成後才能送出訊息
+                self.start_upload(self.attachments.path_for(file_hash), base_name, file_hash)
             else:
-                self.preview_label.config(text=base_name, image="")
-            self.preview_label.pack(side=tk.TOP, fill=tk.X)
+                self.set_attachment(file_hash, base_name)
+
+    def set_attachment(self, file_hash, base_name):
+        new_path = self.attachments.path_for(file_hash)
+        self.attached_file_path = new_path
+        self.attached_file_hash = file_hash
+        self.attached_file_name = base_name
+        if self.is_image_file(base_name):
+            self.preview_label.config(text=f"{base_name}（產生預覽中...）", image="")
+            self.request_thumbnail(file_hash, lambda: Image.open(new_path),
+                                   lambda photos, h=file_hash, n=base_name: self.show_attach_preview(h, n, photos))
+        else:
+            self.preview_label.config(text=base_name, image="")
+        self.preview_label.pack(side=tk.TOP, fill=tk.X)
 
-    def send_file_in_chunks(self, file_path):
-        filesize = os.path.getsize(file_path)
-        chunk_size = 65536  # 64KB
-        total_chunks = (filesize + chunk_size - 1) // chunk_size
-        file_id = os.path.basename(file_path)
-        start_time = time.time()
+    def start_upload(self, file_path, file_name, file_hash=None):
+        self.cancel_upload = False
+        self.uploading = True
+        progress = self.create_upload_progress()
+        threading.Thread(target=self.send_file_in_chunks, args=(file_path, progress, file_name, file_hash),
+                         daemon=True).start()
+
+    def create_upload_progress(self):
         # 建立進度視窗，背景白色，初始置頂 3 秒後取消
         progress_win = tk.Toplevel(self.root)
         progress_win.title("上傳檔案中...")
         progress_win.geometry("200x250")
         progress_win.configure(bg="white")
         progress_win.attributes('-topmost', True)
-        progress_win.after(3000, lambda: progress_win.attributes('-topmost', False))
-        
+        progress_win.after(3000, lambda: progress_win.winfo_exists() and progress_win.attributes('-topmost', False))
+
         canvas_size = 150
         canvas = tk.Canvas(progress_win, width=canvas_size, height=canvas_size, bg="white", highlightthickness=0)
         canvas.pack(pady=10)
@@ -445,54 +1126,198 @@ class ChatClientApp:
         x1, y1 = canvas_size - margin, canvas_size - margin
         # 只建立藍色 arc，初始 extent 為 0且 state 為 hidden
         arc = canvas.create_arc(x0, y0, x1, y1, start=270, extent=0, style="arc", outline="blue", width=2, state="hidden")
-        
+
         time_label = tk.Label(progress_win, text="剩餘時間：--秒", font=("Arial", 12), bg="white")
         time_label.pack(pady=5)
         cancel_btn = tk.Button(progress_win, text="取消", command=lambda: self.cancel_upload_action(progress_win))
         cancel_btn.pack(pady=5)
-        
-        total_sent = 0
-        for chunk_index in range(total_chunks):
-            if self.cancel_upload:
-                progress_win.destroy()
-                messagebox.showinfo("上傳取消", "檔案上傳已取消。")
-                self.uploading = False
-                return False
-            with open(file_path, "rb") as f:
-                f.seek(chunk_index * chunk_size)
-                chunk = f.read(chunk_size)
-            b64_data = base64.b64encode(chunk).decode("utf-8")
-            msg = {
-                "file_chunk": True,
-                "file_id": file_id,
-                "chunk_index": chunk_index,
-                "total_chunks": total_chunks,
-                "data": b64_data
-            }
-            self.send_network_message(json.dumps(msg, ensure_ascii=False))
-            total_sent += len(chunk)
-            progress = total_sent / filesize
-            if progress < 0.01:
-                canvas.itemconfigure(arc, state="hidden")
-            else:
-                canvas.itemconfigure(arc, state="normal")
-                extent = -progress * 360  # 負值表示順時針方向
-                canvas.itemconfig(arc, extent=extent)
-            elapsed = time.time() - start_time
-            speed = total_sent / elapsed if elapsed > 0 else 0
-            remaining = (filesize - total_sent) / speed if speed > 0 else 0
-            time_label.config(text=f"剩餘時間：{int(remaining)}秒")
-            progress_win.update_idletasks()
-            time.sleep(0.01)
-        progress_win.destroy()
+        return {"win": progress_win, "canvas": canvas, "arc": arc, "time_label": time_label}
+
+    def update_upload_progress(self, progress, progress_ratio, remaining):
+        if not progress["win"].winfo_exists():
+            return
+        canvas = progress["canvas"]
+        if progress_ratio < 0.01:
+            canvas.itemconfigure(progress["arc"], state="hidden")
+        else:
+            canvas.itemconfigure(progress["arc"], state="normal")
+            canvas.itemconfig(progress["arc"], extent=-progress_ratio * 360)  # 負值表示順時針方向
+        progress["time_label"].config(text=f"剩餘時間：{int(remaining)}秒")
+
+    def finish_upload(self, progress, file_id, file_name, file_hash):
         self.uploading = False
+        if progress["win"].winfo_exists():
+            progress["win"].destroy()
+        if file_id and file_hash:
+            # 已在伺服器附件庫，訊息與一般附件一樣只帶雜湊
+            self.set_attachment(file_hash, file_name)
+        elif file_id:
+            self.uploaded_file_id = file_id
+            self.uploaded_file_name = file_name
+        elif self.cancel_upload:
+            messagebox.showinfo("上傳取消", "檔案上傳已取消。")
+        else:
+            # 重新選擇同一個檔案會得到相同的 file_id，接收端只需補齊缺少的分塊
+            messagebox.showerror("上傳失敗", "檔案上傳未完成，請重新選擇檔案以續傳。")
+
+    def send_file_in_chunks(self, file_path, progress, file_name, file_hash=None):
+        # 在背景執行緒上傳：先送出每塊的雜湊（manifest），接收端回報缺少的分塊後只送那些
+        # 伺服器有附件庫時，大檔在計算雜湊的同一次讀取中複製進本機附件庫，上傳完成後以雜湊引用
+        # 畫面更新一律透過 root.after 交回 Tk 執行緒
+        filesize = os.path.getsize(file_path)
+        chunk_size = choose_chunk_size(filesize)
+        file_id = None
+        completed = False
+        copy_path = self.attachments.temp_path() if self.server_blobs and not file_hash else None
+        try:
+            result = build_manifest(file_path, chunk_size, lambda: self.cancel_upload, copy_path)
+            if result is not None:
+                digests, whole_hash = result
+                if copy_path:
+                    file_path = self.attachments.commit_temp(copy_path, whole_hash)
+                    copy_path = None
+                if self.server_blobs:
+                    file_hash = whole_hash
+                file_id = manifest_file_id(filesize, chunk_size, digests)
+                completed = self.upload_missing_chunks(file_path, file_id, file_name, filesize, chunk_size,
+                                                       digests, file_hash, progress)
+        except Exception as e:
+            print("檔案上傳失敗:", e)
+        finally:
+            if copy_path and os.path.exists(copy_path):
+                os.remove(copy_path)
+        self.root.after(0, self.finish_upload, progress, file_id if completed else None, file_name,
+                        file_hash if completed else None)
+        return completed
+
+    def upload_missing_chunks(self, file_path, file_id, file_name, filesize, chunk_size, digests, file_hash,
+                              progress):
+        total_chunks = len(digests) // DIGEST_SIZE
+        manifest = {
+            "type": "file_manifest",
+            "file_id": file_id,
+            "file_name": file_name,
+            "file_size": filesize,
+            "chunk_size": chunk_size,
+            "total_chunks": total_chunks,
+            "payload_field": "chunk_hashes"
+        }
+        if file_hash:
+            manifest["file_hash"] = file_hash  # 伺服器已有相同內容時可略過整個上傳
+        # manifest 與 file_status 走聊天連線，分塊盡量走資料連線
+        streams = self.open_data_streams()
+        try:
+            # 多一輪只送 manifest，確認最後一輪補送後是否已經收齊
+            for round_index in range(UPLOAD_MAX_ROUNDS + 1):
+                self.upload_statuses.register(file_id)
+                self.send_network_message(manifest, digests)
+                if self.server_blobs:
+                    statuses = self.upload_statuses.wait(file_id, UPLOAD_SERVER_STATUS_WAIT, expected=1)
+                else:
+                    statuses = self.upload_statuses.wait(file_id, UPLOAD_STATUS_WAIT)
+                if statuses:
+                    pending = set()
+                    for status in statuses:
+                        pending |= ranges_to_indices(status.get("missing") or [], total_chunks)
+                elif round_index == 0:
+                    # 沒有人回報（沒有其他用戶或對方是舊版）就全部送出
+                    pending = set(range(total_chunks))
+                else:
+                    return True
+                if not pending:
+                    return True
+                if round_index == UPLOAD_MAX_ROUNDS:
+                    break
+                tracker = {
+                    "lock": threading.Lock(),
+                    "sent": 0,
+                    "total": sum(min(chunk_size, filesize - i * chunk_size) for i in pending),
+                    "start": time.time(),
+                    "last_update": 0
+                }
+                chunk_meta = {
+                    "file_chunk": True,
+                    "file_id": file_id,
+                    "file_name": file_name,
+                    "chunk_size": chunk_size,
+                    "total_chunks": total_chunks,
+                    "payload_field": "data"
+                }
+                if not self.send_chunks_parallel(file_path, sorted(pending), chunk_meta, streams, tracker, progress):
+                    return False
+            return False
+        finally:
+            self.upload_statuses.unregister(file_id)
+            for sock in streams:
+                sock.close()
+
+    def send_chunks_parallel(self, file_path, indices, chunk_meta, streams, tracker, progress):
+        # 每條資料連線負責一段連續的分塊（各自讀檔，磁碟讀取仍是循序的），送完後等伺服器確認處理完畢；
+        # 斷掉的資料連線從列表移除，漏送的分塊下一輪 file_status 會再回報
+        if not streams:
+            return self.send_chunks(file_path, indices, chunk_meta, self.send_network_message, tracker, progress)
+        per_stream = (len(indices) + len(streams) - 1) // len(streams)
+        results = {}
+        def worker(sock, part):
+            send = lambda msg, payload: self.send_data_frame(sock, msg, payload)
+            try:
+                results[sock] = self.send_chunks(file_path, part, chunk_meta, send, tracker, progress)
+                if results[sock]:
+                    self.sync_data_stream(sock, chunk_meta["file_id"])
+            except OSError as e:
+                print("資料連線傳送失敗:", e)
+                results[sock] = None
+        threads = []
+        for i, sock in enumerate(list(streams)):
+            part = indices[i * per_stream:(i + 1) * per_stream]
+            if part:
+                t = threading.Thread(target=worker, args=(sock, part), daemon=True)
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+        for sock, result in results.items():
+            if result is None:
+                streams.remove(sock)
+                sock.close()
+        return not self.cancel_upload
+
+    def send_chunks(self, file_path, indices, chunk_meta, send, tracker, progress):
+        # 整個檔案只開一次，讀進重複使用的緩衝區；不固定 sleep，
+        # sendall 會在 socket 送出緩衝區滿時阻塞，速度由實際連線決定；回傳 False 表示已取消
+        chunk_size = chunk_meta["chunk_size"]
+        buffer = bytearray(chunk_size)
+        with open(file_path, "rb") as f, memoryview(buffer) as view:
+            for chunk_index in indices:
+                if self.cancel_upload:
+                    return False
+                f.seek(chunk_index * chunk_size)
+                n = f.readinto(buffer)
+                msg = dict(chunk_meta)
+                msg["chunk_index"] = chunk_index
+                send(msg, view[:n])
+                self.report_upload_progress(tracker, n, progress)
         return True
 
+    def report_upload_progress(self, tracker, n, progress):
+        with tracker["lock"]:
+            tracker["sent"] += n
+            now = time.time()
+            if now - tracker["last_update"] < UPLOAD_PROGRESS_INTERVAL:
+                return
+            tracker["last_update"] = now
+            sent = tracker["sent"]
+        elapsed = now - tracker["start"]
+        speed = sent / elapsed if elapsed > 0 else 0
+        remaining = (tracker["total"] - sent) / speed if speed > 0 else 0
+        self.root.after(0, self.update_upload_progress, progress, sent / tracker["total"], remaining)
+
     def cancel_upload_action(self, win):
         self.cancel_upload = True
         win.destroy()
 
-    def copy_file_with_progress(self, src, dst):
+    def copy_file_with_progress(self, src):
+        # 複製進附件庫並同時計算雜湊；回傳雜湊，失敗時回傳 None
         filesize = os.path.getsize(src)
         chunk_size = 65536
         progress_win = tk.Toplevel(self.root)
@@ -504,32 +1329,44 @@ class ChatClientApp:
         progress_bar.pack(pady=10)
         progress_bar["maximum"] = filesize
         total = 0
+        tmp_path = self.attachments.temp_path()
+        digest = hashlib.sha256()
         try:
-            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
                 while True:
                     data = fsrc.read(chunk_size)
                     if not data:
                         break
                     fdst.write(data)
+                    digest.update(data)
                     total += len(data)
                     progress_bar["value"] = total
                     progress_win.update_idletasks()
+            file_hash = digest.hexdigest()
+            self.attachments.commit_temp(tmp_path, file_hash)
             progress_win.destroy()
-            return True
+            return file_hash
         except Exception as e:
             progress_win.destroy()
             print("檔案複製失敗:", e)
-            return False
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
 
-    def get_day_frame(self, date_str):
+    def get_day_frame(self, date_str, at_top=False):
         if date_str in self.day_frames:
             return self.day_frames[date_str]
         else:
             day_frame = tk.Frame(self.main_frame, bg="#2b2b2b")
-            day_frame.pack(fill=tk.X, padx=10, pady=10)
+            existing = self.main_frame.pack_slaves()
+            if at_top and existing:
+                day_frame.pack(fill=tk.X, padx=10, pady=10, before=existing[0])
+            else:
+                day_frame.pack(fill=tk.X, padx=10, pady=10)
             date_label = tk.Label(day_frame, text=f"=== {date_str} ===", bg="#2b2b2b", fg="white",
                                   font=("Arial", 25, "italic"))
             date_label.pack(anchor="w", padx=18, pady=5)
+            day_frame.date_label = date_label
             self.day_frames[date_str] = day_frame
             return day_frame
 
@@ -545,142 +1382,39 @@ class ChatClientApp:
                     segments.append(("secret", chunk))
         return segments
 
-    def create_message_ui(self, msg_data):
-        day_frame = self.get_day_frame(msg_data["date"])
+    def create_message_ui(self, msg_data, show_header=True, at_top=False):
+        day_frame = self.get_day_frame(msg_data["date"], at_top)
         container = tk.Frame(day_frame, bg="#2b2b2b")
-        container.pack(fill=tk.X, padx=1, pady=1)
+        if at_top:
+            container.pack(fill=tk.X, padx=1, pady=1, after=day_frame.date_label)
+        else:
+            container.pack(fill=tk.X, padx=1, pady=1)
         container.bind("<Enter>", lambda e, mid=msg_data["msg_id"]: self.on_enter_message(mid))
         container.bind("<Leave>", lambda e, mid=msg_data["msg_id"]: self.on_leave_message(mid))
         
-        date = msg_data["date"]
         sender = msg_data.get("sender_name", "匿名")
-        show_header = True
-        if date not in self.last_header_info:
-            self.last_header_info[date] = (sender, 1)
-        else:
-            last_sender, count = self.last_header_info[date]
-            if sender != last_sender:
-                self.last_header_info[date] = (sender, 1)
-            else:
-                new_count = count + 1
-                self.last_header_info[date] = (sender, new_count)
-                if new_count % 7 != 1:
-                    show_header = False
 
         if show_header:
             header_frame = tk.Frame(container, bg="#2b2b2b")
             header_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-            if "sender_avatar" in msg_data and msg_data["sender_avatar"]:
-                try:
-                    avatar_bytes = base64.b64decode(msg_data["sender_avatar"])
-                    avatar_img = Image.open(BytesIO(avatar_bytes))
-                    avatar_img.thumbnail(self.avatar_size)
-                    avatar_photo = ImageTk.PhotoImage(avatar_img)
-                    avatar_label = tk.Label(header_frame, image=avatar_photo, bg="#2b2b2b")
-                    avatar_label.image = avatar_photo
-                    avatar_label.pack(side=tk.LEFT)
-                except Exception as e:
-                    print("頭像顯示失敗:", e)
+            if msg_data.get("sender_avatar_hash") or msg_data.get("sender_avatar"):
+                avatar_label = tk.Label(header_frame, image=self.avatar_placeholder, bg="#2b2b2b")
+                avatar_label.pack(side=tk.LEFT)
+                self.request_avatar(msg_data, lambda photo, lbl=avatar_label: self.show_avatar(lbl, photo))
             name_label = tk.Label(header_frame, text=sender, bg="#2b2b2b", fg="white", font=("Arial",16))
             name_label.pack(side=tk.LEFT, padx=5)
         left_frame = tk.Frame(container, bg="#2b2b2b")
         left_frame.pack(side=tk.LEFT, anchor="nw")
         text_frame = tk.Frame(left_frame, bg="#2b2b2b")
         text_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-        segments = self.parse_text_with_secret(msg_data["text"])
-        if segments:
-            for segtype, segtext in segments:
-                if segtype == "normal":
-                    lbl = tk.Label(text_frame, text=segtext, bg="#2b2b2b", fg="white", font=self.message_font)
-                    lbl.pack(side=tk.LEFT, anchor="w")
-                else:
-                    hidden_lbl = tk.Label(text_frame, text="點一下顯示", bg="#555555", fg="white", font=self.message_font)
-                    hidden_lbl.pack(side=tk.LEFT, anchor="w", padx=2)
-                    store = {"hidden": True, "secret_text": segtext}
-                    def on_toggle(e, lb=hidden_lbl, d=store):
-                        if d["hidden"]:
-                            lb.config(text=d["secret_text"], bg="#2b2b2b")
-                            d["hidden"] = False
-                        else:
-                            lb.config(text="點一下顯示", bg="#555555")
-                            d["hidden"] = True
-                    hidden_lbl.bind("<Button-1>", on_toggle)
+        self.fill_text_frame(text_frame, msg_data["text"])
         if msg_data["msg_id"] not in self.ephemeral_map:
             self.ephemeral_map[msg_data["msg_id"]] = {}
         self.ephemeral_map[msg_data["msg_id"]]["text_frame"] = text_frame
 
         attach_frame = tk.Frame(left_frame, bg="#2b2b2b")
         attach_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-        original_photo = None
-        hover_photo = None
-        canvas_for_image = None
-        if "file_data" in msg_data:
-            file_name = msg_data.get("file_name", "download_file")
-            if msg_data.get("is_image", False):
-                try:
-                    file_bytes = base64.b64decode(msg_data["file_data"])
-                    img = Image.open(BytesIO(file_bytes))
-                    img.thumbnail(self.image_thumbnail_size)
-                    original_photo = ImageTk.PhotoImage(img)
-                    alpha_img = self.make_alpha_image(img, alpha=0.7)
-                    hover_photo = ImageTk.PhotoImage(alpha_img)
-                    canvas_for_image = tk.Canvas(attach_frame,
-                                                  width=self.image_thumbnail_size[0],
-                                                  height=self.image_thumbnail_size[1],
-                                                  bg="#2b2b2b", highlightthickness=0)
-                    canvas_for_image.pack(anchor="w")
-                    canvas_for_image.create_image(0, 0, anchor="nw", image=original_photo)
-                except Exception as e:
-                    print("解碼圖片失敗:", e)
-                    tk.Label(attach_frame, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
-                             font=self.message_font).pack(anchor="w")
-            else:
-                def download_file():
-                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                    if save_path:
-                        try:
-                            with open(save_path, "wb") as f:
-                                f.write(base64.b64decode(msg_data["file_data"]))
-                            messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
-                        except Exception as e:
-                            messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
-                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
-                          font=self.message_font, command=download_file).pack(anchor="w")
-        elif msg_data.get("file_path"):
-            file_name = os.path.basename(msg_data["file_path"])
-            if msg_data["is_image"]:
-                canvas_for_image = tk.Canvas(attach_frame,
-                                              width=self.image_thumbnail_size[0],
-                                              height=self.image_thumbnail_size[1],
-                                              bg="#2b2b2b", highlightthickness=0)
-                canvas_for_image.pack(anchor="w")
-                try:
-                    img = Image.open(msg_data["file_path"])
-                    img.thumbnail(self.image_thumbnail_size)
-                    original_photo = ImageTk.PhotoImage(img)
-                    alpha_img = self.make_alpha_image(img, alpha=0.7)
-                    hover_photo = ImageTk.PhotoImage(alpha_img)
-                    canvas_for_image.create_image(0, 0, anchor="nw", image=original_photo)
-                except:
-                    tk.Label(attach_frame, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
-                             font=self.message_font).pack(anchor="w")
-                else:
-                    canvas_for_image.bind("<Enter>", lambda e, fn=file_name, mid=msg_data["msg_id"]: self.on_image_enter(mid, fn))
-                    canvas_for_image.bind("<Leave>", lambda e, mid=msg_data["msg_id"]: self.on_image_leave(mid))
-            else:
-                def download_file():
-                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                    if save_path:
-                        try:
-                            with open(msg_data["file_path"], "rb") as src_file:
-                                data = src_file.read()
-                            with open(save_path, "wb") as dest_file:
-                                dest_file.write(data)
-                            messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
-                        except Exception as e:
-                            messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
-                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
-                          font=self.message_font, command=download_file).pack(anchor="w")
+        canvas_for_image, thumbnail_request, file_name = self.build_attachment(attach_frame, msg_data)
         right_frame = tk.Frame(container, bg="#2b2b2b")
         right_frame.pack(side=tk.RIGHT, anchor="n")
         time_label = tk.Label(right_frame, text=msg_data["timestamp"], bg="#2b2b2b", fg="white", font=("Arial",20))
@@ -700,10 +1434,120 @@ class ChatClientApp:
             "time_label": time_label,
             "edit_btn": edit_btn,
             "del_btn": del_btn,
+            "attach_frame": attach_frame,
             "canvas_for_image": canvas_for_image,
-            "original_photo": original_photo,
-            "hover_photo": hover_photo
+            "original_photo": None,
+            "hover_photo": None
         })
+        if thumbnail_request:
+            self.start_thumbnail(msg_data["msg_id"], canvas_for_image, file_name, thumbnail_request)
+
+    def fill_text_frame(self, text_frame, text):
+        for segtype, segtext in self.parse_text_with_secret(text):
+            if segtype == "normal":
+                lbl = tk.Label(text_frame, text=segtext, bg="#2b2b2b", fg="white", font=self.message_font)
+                lbl.pack(side=tk.LEFT, anchor="w")
+            else:
+                hidden_lbl = tk.Label(text_frame, text="點一下顯示", bg="#555555", fg="white", font=self.message_font)
+                hidden_lbl.pack(side=tk.LEFT, anchor="w", padx=2)
+                store = {"hidden": True, "secret_text": segtext}
+                def on_toggle(e, lb=hidden_lbl, d=store):
+                    if d["hidden"]:
+                        lb.config(text=d["secret_text"], bg="#2b2b2b")
+                        d["hidden"] = False
+                    else:
+                        lb.config(text="點一下顯示", bg="#555555")
+                        d["hidden"] = True
+                hidden_lbl.bind("<Button-1>", on_toggle)
+
+    def build_attachment(self, attach_frame, msg_data):
+        # 建立附件區的元件，回傳 (圖片畫布, 縮圖請求, 檔名)；縮圖請求為 (內容雜湊, 開啟原圖的函式)，
+        # 等訊息元件都建立後才送進背景解碼
+        canvas_for_image = None
+        thumbnail_request = None
+        file_name = None
+        if "file_data" in msg_data:
+            file_name = msg_data.get("file_name", "download_file")
+            if msg_data.get("is_image", False):
+                canvas_for_image = self.create_image_placeholder(attach_frame)
+                digest = hashlib.sha256(msg_data["file_data"].encode("ascii")).hexdigest()
+                thumbnail_request = (digest, lambda: Image.open(BytesIO(base64.b64decode(msg_data["file_data"]))))
+            else:
+                def download_file():
+                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
+                    if save_path:
+                        try:
+                            with open(save_path, "wb") as f:
+                                f.write(base64.b64decode(msg_data["file_data"]))
+                            messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
+                        except Exception as e:
+                            messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
+                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
+                          font=self.message_font, command=download_file).pack(anchor="w")
+        elif msg_data.get("file_hash") or msg_data.get("file_path"):
+            file_hash = msg_data.get("file_hash")
+            if file_hash:
+                local_path = self.attachments.find(file_hash)
+            else:
+                local_path = msg_data["file_path"]
+            file_name = msg_data.get("file_name") or os.path.basename(local_path or "download_file")
+            if not local_path and file_hash and self.server_blobs and file_hash not in self.unavailable_blobs:
+                # 本機還沒有這個附件：圖片出現在畫面上時自動下載，其他檔案按下才下載
+                if msg_data.get("is_image"):
+                    canvas_for_image = self.create_image_placeholder(attach_frame)
+                    self.request_blob(file_hash, file_name)
+                else:
+                    tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
+                              font=self.message_font,
+                              command=lambda: self.download_attachment(file_hash, file_name)).pack(anchor="w")
+            elif not local_path:
+                tk.Label(attach_frame, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
+                         font=self.message_font).pack(anchor="w")
+            elif msg_data.get("is_image"):
+                canvas_for_image = self.create_image_placeholder(attach_frame)
+                thumbnail_request = (file_hash or local_path, lambda: Image.open(local_path))
+            else:
+                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
+                          font=self.message_font,
+                          command=lambda: self.save_attachment_as(local_path, file_name)).pack(anchor="w")
+        return canvas_for_image, thumbnail_request, file_name
+
+    def start_thumbnail(self, msg_id, canvas, file_name, thumbnail_request):
+        digest, open_image = thumbnail_request
+        self.request_thumbnail(digest, open_image,
+                               lambda photos: self.show_thumbnail(msg_id, canvas, file_name, photos))
+
+    def refresh_attachment(self, file_hash):
+        # 附件下載完成後，重建目前畫面上引用它的訊息的附件區
+        for msg_data in self.messages_data[self.render_start:self.render_end]:
+            if msg_data.get("file_hash") != file_hash:
+                continue
+            ep = self.ephemeral_map.get(msg_data["msg_id"])
+            if not ep or not ep.get("attach_frame"):
+                continue
+            for child in ep["attach_frame"].winfo_children():
+                child.destroy()
+            canvas_for_image, thumbnail_request, file_name = self.build_attachment(ep["attach_frame"], msg_data)
+            ep.update({"canvas_for_image": canvas_for_image, "original_photo": None, "hover_photo": None})
+            if thumbnail_request:
+                self.start_thumbnail(msg_data["msg_id"], canvas_for_image, file_name, thumbnail_request)
+
+    def save_attachment_as(self, local_path, file_name):
+        save_path = filedialog.asksaveasfilename(initialfile=file_name)
+        if save_path:
+            try:
+                shutil.copyfile(local_path, save_path)
+                messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
+            except Exception as e:
+                messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
+
+    def download_attachment(self, file_hash, file_name):
+        local_path = self.attachments.find(file_hash)
+        if local_path:
+            self.save_attachment_as(local_path, file_name)
+            return
+        self.pending_saves[file_hash] = file_name
+        self.request_blob(file_hash, file_name)
 
     def on_edit_message_inplace(self, msg_data):
         mid = msg_data["msg_id"]
@@ -732,28 +1576,14 @@ class ChatClientApp:
             entry.destroy()
             for child in text_frame.winfo_children():
                 child.destroy()
-            segments = self.parse_text_with_secret(new_text)
-            for segtype, segtext in segments:
-                if segtype == "normal":
-                    lbl = tk.Label(text_frame, text=segtext, bg="#2b2b2b", fg="white", font=self.message_font)
-                    lbl.pack(side=tk.LEFT, anchor="w")
-                else:
-                    hidden_lbl = tk.Label(text_frame, text="點一下顯示", bg="#555555", fg="white", font=self.message_font)
-                    hidden_lbl.pack(side=tk.LEFT, anchor="w", padx=2)
-                    store = {"hidden": True, "secret_text": segtext}
-                    def on_toggle(e, lb=hidden_lbl, d=store):
-                        if d["hidden"]:
-                            lb.config(text=d["secret_text"], bg="#2b2b2b")
-                            d["hidden"] = False
-                        else:
-                            lb.config(text="點一下顯示", bg="#555555")
-                            d["hidden"] = True
-                    hidden_lbl.bind("<Button-1>", on_toggle)
+            self.fill_text_frame(text_frame, new_text)
             if attach_frame:
                 text_frame.pack(before=attach_frame, anchor="w", padx=5, pady=2)
             else:
                 text_frame.pack(anchor="w", padx=5, pady=2)
-            self.save_data()
+            self.save_edit(mid, new_text)
+            if self.is_own_message(msg_data):
+                self.send_edit(msg_data)
         def cancel_edit(event=None):
             entry.destroy()
             if attach_frame:
@@ -780,624 +1610,113 @@ class ChatClientApp:
     def on_delete_message(self, msg_id):
         if not messagebox.askyesno("確認刪除", "確定要刪除此訊息嗎？"):
             return
-        idx = None
-        for i, m in enumerate(self.messages_data):
-            if m["msg_id"] == msg_id:
-                idx = i
-                break
-        if idx is not None:
-            self.messages_data.pop(idx)
-        ep = self.ephemeral_map.pop(msg_id, None)
-        if ep:
-            ep["container"].destroy()
-        self.save_data()
-
-    def make_alpha_image(self, pil_img, alpha=0.7):
-        if pil_img.mode != "RGBA":
-            new_img = pil_img.convert("RGBA")
+        msg_data = self.remove_message(msg_id)
+        if msg_data is not None and self.is_own_message(msg_data):
+            self.send_delete(msg_data)
+
+    def remove_message(self, msg_id):
+        idx = self.message_index(msg_id)
+        if idx is None:
+            return None
+        msg_data = self.messages_data[idx]
+        self.remove_message_ui(msg_data)
+        del self.seq_by_id[msg_id]
+        del self.messages_data[idx]
+        del self.message_seqs[idx]
+        if msg_data in self.inbound_added:
+            # 同一批收到又刪除，還沒顯示過
+            self.inbound_added.remove(msg_data)
+        if idx < self.render_start:
+            self.render_start -= 1
+            self.render_end -= 1
+        elif idx < self.render_end:
+            self.render_end -= 1
+        self.save_delete(msg_id)
+        return msg_data
+
+    def request_avatar(self, msg_data, callback):
+        if msg_data.get("sender_avatar_hash"):
+            digest = msg_data["sender_avatar_hash"]
+            load = lambda: self.get_avatar_bytes(digest)
+        elif msg_data.get("sender_avatar"):
+            # 舊紀錄直接內嵌 base64 頭像，以 base64 字串的雜湊當 key
+            digest = hashlib.sha256(msg_data["sender_avatar"].encode("ascii")).hexdigest()
+            load = lambda: base64.b64decode(msg_data["sender_avatar"])
         else:
-            new_img = pil_img.copy()
-        new_img.putalpha(int(255 * alpha))
-        return new_img
-
-    def on_image_enter(self, msg_id, file_name):
-        ep = self.ephemeral_map.get(msg_id)
-        if not ep:
-            return
-        c = ep["canvas_for_image"]
-        if not c:
-            return
-        hp = ep["hover_photo"]
-        if not hp:
-            return
-        w = self.image_thumbnail_size[0]
-        h = self.image_thumbnail_size[1]
-        c.delete("all")
-        c.create_image(0, 0, anchor="nw", image=hp)
-        c.create_text(w//2, h//2, text=file_name, fill="white", font=("Arial",18), anchor="center")
-
-    def on_image_leave(self, msg_id):
-        ep = self.ephemeral_map.get(msg_id)
-        if not ep:
-            return
-        c = ep["canvas_for_image"]
-        if not c:
-            return
-        op = ep["original_photo"]
-        if not op:
-            return
-        c.delete("all")
-        c.create_image(0, 0, anchor="nw", image=op)
-
-    def on_search_icon_click(self):
-        if self.search_entry.cget("width") == 0:
-            self.search_entry.config(width=20)
-            self.search_entry.focus_set()
-        else:
-            self.search_entry.config(width=0)
-            self.search_listbox.place_forget()
-
-    def on_search_var_changed(self, *args):
-        kw = self.search_var.get().strip()
-        if not kw:
-            self.search_listbox.place_forget()
-            return
-        results = []
-        for m in self.messages_data:
-            if kw.lower() in m["text"].lower():
-                st = m["text"]
-                if len(st) > 30:
-                    st = st[:30] + "..."
-                results.append((m["msg_id"], st))
-        if not results:
-            self.search_listbox.place_forget()
-            return
-        x = self.search_entry.winfo_rootx()
-        y = self.search_entry.winfo_rooty() + self.search_entry.winfo_height()
-        self.search_listbox.delete(0, tk.END)
-        for (mid, st) in results:
-            self.search_listbox.insert(tk.END, f"[{mid}] {st}")
-        self.search_listbox.place(x=x, y=y, width=300, height=120)
-        self.search_listbox.bind("<<ListboxSelect>>", self.on_search_select)
-
-    def on_search_select(self, event):
-        if not self.search_listbox.curselection():
             return
-        idx = self.search_listbox.curselection()[0]
-        line = self.search_listbox.get(idx)
-        try:
-            lb = line.index("[")
-            rb = line.index("]")
-            msg_id_str = line[lb+1:rb]
-            msg_id = int(msg_id_str)
-        except:
-            return
-        self.search_listbox.place_forget()
-        ep = self.ephemeral_map.get(msg_id)
-        if not ep:
-            return
-        container = ep["container"]
-        y = container.winfo_rooty() - self.canvas.winfo_rooty() + self.canvas.canvasy(0)
-        self.canvas.yview_moveto(y / self.canvas.bbox("all")[3])
-
-    def toggle_user_list(self, event):
-        if self.user_list_frame.winfo_ismapped():
-            self.user_list_frame.lower()
-        else:
-            for widget in self.user_list_frame.winfo_children():
-                widget.destroy()
-            title = tk.Label(self.user_list_frame, text="可聊天使用者", font=("Arial", 30), bg="#333333", fg="white")
-            title.pack(pady=20)
-            for user in self.user_list:
-                user_label = tk.Label(self.user_list_frame, text=user, font=("Arial", 20), bg="#333333", fg="white")
-                user_label.pack(pady=10, fill="x")
-                user_label.configure(anchor="center")
-            self.user_list_frame.lift()
-
-    def prepare_message(self, text):
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y/%m/%d")
-        time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
-        msg_data = {
-            "msg_id": msg_id,
-            "text": text,
-            "date": date_str,
-            "timestamp": time_str,
-            "file_path": None,
-            "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
-        }
-        if self.uploaded_file_id:
-            msg_data["file_chunked"] = True
-            msg_data["file_id"] = self.uploaded_file_id
-        elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
-                msg_data["is_image"] = True
-            try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
-            except Exception as e:
-                print("檔案編碼失敗:", e)
-        return json.dumps(msg_data, ensure_ascii=False)
-
-    def send_message(self, text):
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y/%m/%d")
-        time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
-        msg_data = {
-            "msg_id": msg_id,
-            "text": text,
-            "date": date_str,
-            "timestamp": time_str,
-            "file_path": None,
-            "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
-        }
-        if self.uploaded_file_id:
-            msg_data["file_chunked"] = True
-            msg_data["file_id"] = self.uploaded_file_id
-        elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
-                msg_data["is_image"] = True
-            try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
-            except Exception as e:
-                print("檔案編碼失敗:", e)
-        self.create_message_ui(msg_data)
-        self.messages_data.append(msg_data)
-        self.entry_var.set("")
-        self.preview_label.pack_forget()
-        self.preview_label.config(text="", image="")
-        self.attached_file_path = None
-        self.attached_file_preview = None
-        self.uploaded_file_id = None
-        self.scroll_to_bottom()
-        self.save_data()
-
-    def on_close(self):
-        self.save_data()
-        if self.socket:
-            self.socket.close()
-        self.root.destroy()
-
-    def load_data(self):
-        self.last_header_info = {}
-        if os.path.exists(self.data_path):
-            try:
-                with open(self.data_path, "r", encoding="utf-8") as f:
-                    saved_msgs = json.load(f)
-            except Exception as e:
-                print("讀取舊紀錄失敗:", e)
-                return
-            for m in saved_msgs:
-                self.create_message_ui(m)
-            self.messages_data = saved_msgs
-        self.scroll_to_bottom()
-
-    def save_data(self):
-        try:
-            with open(self.data_path, "w", encoding="utf-8") as f:
-                json.dump(self.messages_data, f, ensure_ascii=False, indent=2)
-            print("已儲存資料至", self.data_path)
-        except Exception as e:
-            print("儲存資料失敗:", e)
-
-    def attach_file(self):
-        orig_path = filedialog.askopenfilename()
-        if not orig_path:
+        size = self.avatar_size
+        def decode():
+            avatar_bytes = load()
+            if not avatar_bytes:
+                return None  # 頭像還沒收到
+            avatar_img = Image.open(BytesIO(avatar_bytes))
+            avatar_img.thumbnail(size)
+            return avatar_img
+        def build(avatar_img):
+            photo = ImageTk.PhotoImage(avatar_img)
+            return photo, photo_cost(photo)
+        self.image_loader.request(("avatar", digest, size), decode, build, callback)
+
+    def request_thumbnail(self, digest, open_image, callback):
+        # callback 收到 (原圖縮圖, 滑鼠移入時的半透明版本)，同一張圖只解碼一次
+        size = self.image_thumbnail_size
+        def decode():
+            images = self.thumbnails.load(digest, size)
+            if images:
+                return images
+            img = open_image()
+            img.draft(img.mode, size)  # JPEG 可直接以較低解析度解碼
+            img.thumbnail(size)
+            images = (img, self.make_alpha_image(img, alpha=0.7))
+            self.thumbnails.save(digest, size, *images)
+            return images
+        def build(images):
+            photos = (ImageTk.PhotoImage(images[0]), ImageTk.PhotoImage(images[1]))
+            return photos, photo_cost(*photos)
+        self.image_loader.request(("thumb", digest, size), decode, build, callback)
+
+    def create_image_placeholder(self, parent):
+        w, h = self.image_thumbnail_size
+        canvas = tk.Canvas(parent, width=w, height=h, bg="#2b2b2b", highlightthickness=0)
+        canvas.pack(anchor="w")
+        canvas.create_text(w//2, h//2, text="載入中...", fill="#888888", font=("Arial", 16), anchor="center")
+        return canvas
+
+    def show_avatar(self, label, photo):
+        # 解碼失敗或頭像尚未收到時保留空白佔位，避免版面跳動
+        if photo is None or not label.winfo_exists():
             return
-        # 所有檔案（包含影片）皆走附件上傳流程
-        filesize = os.path.getsize(orig_path)
-        if filesize > CHUNK_THRESHOLD:
-            self.cancel_upload = False
-            self.uploaded_file_id = os.path.basename(orig_path)
-            self.uploading = True
-            threading.Thread(target=self.send_file_in_chunks, args=(orig_path,), daemon=True).start()
-            messagebox.showinfo("上傳中", "超大檔案正在分塊上傳中，請稍候...")
-        else:
-            base_name = os.path.basename(orig_path)
-            new_path = os.path.join(self.attachments_dir, base_name)
-            if not self.copy_file_with_progress(orig_path, new_path):
-                return
-            self.attached_file_path = new_path
-            if self.is_image_file(new_path):
-                try:
-                    img = Image.open(new_path)
-                    img.thumbnail(self.image_thumbnail_size)
-                    preview_img = ImageTk.PhotoImage(img)
-                    self.attached_file_preview = preview_img
-                    self.preview_label.config(image=preview_img, text="")
-                except:
-                    self.preview_label.config(text=base_name, image="")
-            else:
-                self.preview_label.config(text=base_name, image="")
-            self.preview_label.pack(side=tk.TOP, fill=tk.X)
-
-    def send_file_in_chunks(self, file_path):
-        filesize = os.path.getsize(file_path)
-        chunk_size = 65536  # 64KB
-        total_chunks = (filesize + chunk_size - 1) // chunk_size
-        file_id = os.path.basename(file_path)
-        start_time = time.time()
-        # 建立進度視窗，背景白色，初始置頂 3 秒後取消
-        progress_win = tk.Toplevel(self.root)
-        progress_win.title("上傳檔案中...")
-        progress_win.geometry("200x250")
-        progress_win.configure(bg="white")
-        progress_win.attributes('-topmost', True)
-        progress_win.after(3000, lambda: progress_win.attributes('-topmost', False))
-        
-        canvas_size = 150
-        canvas = tk.Canvas(progress_win, width=canvas_size, height=canvas_size, bg="white", highlightthickness=0)
-        canvas.pack(pady=10)
-        margin = 10
-        x0, y0 = margin, margin
-        x1, y1 = canvas_size - margin, canvas_size - margin
-        # 只建立藍色 arc，初始 extent 為 0且 state 為 hidden
-        arc = canvas.create_arc(x0, y0, x1, y1, start=270, extent=0, style="arc", outline="blue", width=2, state="hidden")
-        
-        time_label = tk.Label(progress_win, text="剩餘時間：--秒", font=("Arial", 12), bg="white")
-        time_label.pack(pady=5)
-        cancel_btn = tk.Button(progress_win, text="取消", command=lambda: self.cancel_upload_action(progress_win))
-        cancel_btn.pack(pady=5)
-        
-        total_sent = 0
-        for chunk_index in range(total_chunks):
-            if self.cancel_upload:
-                progress_win.destroy()
-                messagebox.showinfo("上傳取消", "檔案上傳已取消。")
-                self.uploading = False
-                return False
-            with open(file_path, "rb") as f:
-                f.seek(chunk_index * chunk_size)
-                chunk = f.read(chunk_size)
-            b64_data = base64.b64encode(chunk).decode("utf-8")
-            msg = {
-                "file_chunk": True,
-                "file_id": file_id,
-                "chunk_index": chunk_index,
-                "total_chunks": total_chunks,
-                "data": b64_data
-            }
-            self.send_network_message(json.dumps(msg, ensure_ascii=False))
-            total_sent += len(chunk)
-            progress = total_sent / filesize
-            if progress < 0.01:
-                canvas.itemconfigure(arc, state="hidden")
-            else:
-                canvas.itemconfigure(arc, state="normal")
-                extent = -progress * 360  # 負值表示順時針方向
-                canvas.itemconfig(arc, extent=extent)
-            elapsed = time.time() - start_time
-            speed = total_sent / elapsed if elapsed > 0 else 0
-            remaining = (filesize - total_sent) / speed if speed > 0 else 0
-            time_label.config(text=f"剩餘時間：{int(remaining)}秒")
-            progress_win.update_idletasks()
-            time.sleep(0.01)
-        progress_win.destroy()
-        self.uploading = False
-        return True
-
-    def cancel_upload_action(self, win):
-        self.cancel_upload = True
-        win.destroy()
-
-    def copy_file_with_progress(self, src, dst):
-        filesize = os.path.getsize(src)
-        chunk_size = 65536
-        progress_win = tk.Toplevel(self.root)
-        progress_win.title("上傳檔案中...")
-        progress_win.geometry("300x100")
-        progress_label = tk.Label(progress_win, text="上傳中...", font=("Arial", 12))
-        progress_label.pack(pady=10)
-        progress_bar = ttk.Progressbar(progress_win, orient="horizontal", length=250, mode="determinate")
-        progress_bar.pack(pady=10)
-        progress_bar["maximum"] = filesize
-        total = 0
-        try:
-            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
-                while True:
-                    data = fsrc.read(chunk_size)
-                    if not data:
-                        break
-                    fdst.write(data)
-                    total += len(data)
-                    progress_bar["value"] = total
-                    progress_win.update_idletasks()
-            progress_win.destroy()
-            return True
-        except Exception as e:
-            progress_win.destroy()
-            print("檔案複製失敗:", e)
-            return False
-
-    def get_day_frame(self, date_str):
-        if date_str in self.day_frames:
-            return self.day_frames[date_str]
-        else:
-            day_frame = tk.Frame(self.main_frame, bg="#2b2b2b")
-            day_frame.pack(fill=tk.X, padx=10, pady=10)
-            date_label = tk.Label(day_frame, text=f"=== {date_str} ===", bg="#2b2b2b", fg="white",
-                                  font=("Arial", 25, "italic"))
-            date_label.pack(anchor="w", padx=18, pady=5)
-            self.day_frames[date_str] = day_frame
-            return day_frame
-
-    def parse_text_with_secret(self, text):
-        parts = text.split("||")
-        segments = []
-        for i, chunk in enumerate(parts):
-            if i % 2 == 0:
-                if chunk:
-                    segments.append(("normal", chunk))
-            else:
-                if chunk:
-                    segments.append(("secret", chunk))
-        return segments
-
-    def create_message_ui(self, msg_data):
-        day_frame = self.get_day_frame(msg_data["date"])
-        container = tk.Frame(day_frame, bg="#2b2b2b")
-        container.pack(fill=tk.X, padx=1, pady=1)
-        container.bind("<Enter>", lambda e, mid=msg_data["msg_id"]: self.on_enter_message(mid))
-        container.bind("<Leave>", lambda e, mid=msg_data["msg_id"]: self.on_leave_message(mid))
-        
-        date = msg_data["date"]
-        sender = msg_data.get("sender_name", "匿名")
-        show_header = True
-        if date not in self.last_header_info:
-            self.last_header_info[date] = (sender, 1)
-        else:
-            last_sender, count = self.last_header_info[date]
-            if sender != last_sender:
-                self.last_header_info[date] = (sender, 1)
-            else:
-                new_count = count + 1
-                self.last_header_info[date] = (sender, new_count)
-                if new_count % 7 != 1:
-                    show_header = False
-
-        if show_header:
-            header_frame = tk.Frame(container, bg="#2b2b2b")
-            header_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-            if "sender_avatar" in msg_data and msg_data["sender_avatar"]:
-                try:
-                    avatar_bytes = base64.b64decode(msg_data["sender_avatar"])
-                    avatar_img = Image.open(BytesIO(avatar_bytes))
-                    avatar_img.thumbnail(self.avatar_size)
-                    avatar_photo = ImageTk.PhotoImage(avatar_img)
-                    avatar_label = tk.Label(header_frame, image=avatar_photo, bg="#2b2b2b")
-                    avatar_label.image = avatar_photo
-                    avatar_label.pack(side=tk.LEFT)
-                except Exception as e:
-                    print("頭像顯示失敗:", e)
-            name_label = tk.Label(header_frame, text=sender, bg="#2b2b2b", fg="white", font=("Arial",16))
-            name_label.pack(side=tk.LEFT, padx=5)
-        left_frame = tk.Frame(container, bg="#2b2b2b")
-        left_frame.pack(side=tk.LEFT, anchor="nw")
-        text_frame = tk.Frame(left_frame, bg="#2b2b2b")
-        text_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-        segments = self.parse_text_with_secret(msg_data["text"])
-        if segments:
-            for segtype, segtext in segments:
-                if segtype == "normal":
-                    lbl = tk.Label(text_frame, text=segtext, bg="#2b2b2b", fg="white", font=self.message_font)
-                    lbl.pack(side=tk.LEFT, anchor="w")
-                else:
-                    hidden_lbl = tk.Label(text_frame, text="點一下顯示", bg="#555555", fg="white", font=self.message_font)
-                    hidden_lbl.pack(side=tk.LEFT, anchor="w", padx=2)
-                    store = {"hidden": True, "secret_text": segtext}
-                    def on_toggle(e, lb=hidden_lbl, d=store):
-                        if d["hidden"]:
-                            lb.config(text=d["secret_text"], bg="#2b2b2b")
-                            d["hidden"] = False
-                        else:
-                            lb.config(text="點一下顯示", bg="#555555")
-                            d["hidden"] = True
-                    hidden_lbl.bind("<Button-1>", on_toggle)
-        if msg_data["msg_id"] not in self.ephemeral_map:
-            self.ephemeral_map[msg_data["msg_id"]] = {}
-        self.ephemeral_map[msg_data["msg_id"]]["text_frame"] = text_frame
-
-        attach_frame = tk.Frame(left_frame, bg="#2b2b2b")
-        attach_frame.pack(side=tk.TOP, anchor="w", padx=5, pady=2)
-        original_photo = None
-        hover_photo = None
-        canvas_for_image = None
-        if "file_data" in msg_data:
-            file_name = msg_data.get("file_name", "download_file")
-            if msg_data.get("is_image", False):
-                try:
-                    file_bytes = base64.b64decode(msg_data["file_data"])
-                    img = Image.open(BytesIO(file_bytes))
-                    img.thumbnail(self.image_thumbnail_size)
-                    original_photo = ImageTk.PhotoImage(img)
-                    alpha_img = self.make_alpha_image(img, alpha=0.7)
-                    hover_photo = ImageTk.PhotoImage(alpha_img)
-                    canvas_for_image = tk.Canvas(attach_frame,
-                                                  width=self.image_thumbnail_size[0],
-                                                  height=self.image_thumbnail_size[1],
-                                                  bg="#2b2b2b", highlightthickness=0)
-                    canvas_for_image.pack(anchor="w")
-                    canvas_for_image.create_image(0, 0, anchor="nw", image=original_photo)
-                except Exception as e:
-                    print("解碼圖片失敗:", e)
-                    tk.Label(attach_frame, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
-                             font=self.message_font).pack(anchor="w")
-            else:
-                def download_file():
-                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                    if save_path:
-                        try:
-                            with open(save_path, "wb") as f:
-                                f.write(base64.b64decode(msg_data["file_data"]))
-                            messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
-                        except Exception as e:
-                            messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
-                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
-                          font=self.message_font, command=download_file).pack(anchor="w")
-        elif msg_data.get("file_path"):
-            file_name = os.path.basename(msg_data["file_path"])
-            if msg_data["is_image"]:
-                canvas_for_image = tk.Canvas(attach_frame,
-                                              width=self.image_thumbnail_size[0],
-                                              height=self.image_thumbnail_size[1],
-                                              bg="#2b2b2b", highlightthickness=0)
-                canvas_for_image.pack(anchor="w")
-                try:
-                    img = Image.open(msg_data["file_path"])
-                    img.thumbnail(self.image_thumbnail_size)
-                    original_photo = ImageTk.PhotoImage(img)
-                    alpha_img = self.make_alpha_image(img, alpha=0.7)
-                    hover_photo = ImageTk.PhotoImage(alpha_img)
-                    canvas_for_image.create_image(0, 0, anchor="nw", image=original_photo)
-                except:
-                    tk.Label(attach_frame, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
-                             font=self.message_font).pack(anchor="w")
-                else:
-                    canvas_for_image.bind("<Enter>", lambda e, fn=file_name, mid=msg_data["msg_id"]: self.on_image_enter(mid, fn))
-                    canvas_for_image.bind("<Leave>", lambda e, mid=msg_data["msg_id"]: self.on_image_leave(mid))
-            else:
-                def download_file():
-                    save_path = filedialog.asksaveasfilename(initialfile=file_name)
-                    if save_path:
-                        try:
-                            with open(msg_data["file_path"], "rb") as src_file:
-                                data = src_file.read()
-                            with open(save_path, "wb") as dest_file:
-                                dest_file.write(data)
-                            messagebox.showinfo("下載完成", f"檔案已儲存到 {save_path}")
-                        except Exception as e:
-                            messagebox.showerror("錯誤", f"儲存檔案失敗: {e}")
-                tk.Button(attach_frame, text=f"下載 {file_name}", bg="#555555", fg="white",
-                          font=self.message_font, command=download_file).pack(anchor="w")
-        right_frame = tk.Frame(container, bg="#2b2b2b")
-        right_frame.pack(side=tk.RIGHT, anchor="n")
-        time_label = tk.Label(right_frame, text=msg_data["timestamp"], bg="#2b2b2b", fg="white", font=("Arial",20))
-        edit_btn = tk.Button(right_frame, text="編輯", bg="#4a4a4a", fg="white",
-                             activebackground="#000000", activeforeground="white",
-                             command=lambda: self.on_edit_message_inplace(msg_data))
-        edit_btn.bind("<Enter>", lambda e: edit_btn.config(bg="#2b2b2b"))
-        edit_btn.bind("<Leave>", lambda e: edit_btn.config(bg="#4a4a4a"))
-        del_btn = tk.Button(right_frame, text="刪除", bg="#4a4a4a", fg="white",
-                            activebackground="#000000", activeforeground="white",
-                            command=lambda: self.on_delete_message(msg_data["msg_id"]))
-        del_btn.bind("<Enter>", lambda e: del_btn.config(bg="#2b2b2b"))
-        del_btn.bind("<Leave>", lambda e: del_btn.config(bg="#4a4a4a"))
-        self.ephemeral_map[msg_data["msg_id"]].update({
-            "container": container,
-            "right_frame": right_frame,
-            "time_label": time_label,
-            "edit_btn": edit_btn,
-            "del_btn": del_btn,
-            "canvas_for_image": canvas_for_image,
-            "original_photo": original_photo,
-            "hover_photo": hover_photo
-        })
-
-    def on_edit_message_inplace(self, msg_data):
-        mid = msg_data["msg_id"]
-        ep = self.ephemeral_map.get(mid)
-        if not ep or "text_frame" not in ep:
+        label.config(image=photo)
+        label.image = photo
+
+    def show_thumbnail(self, msg_id, canvas, file_name, photos):
+        if not canvas.winfo_exists():
+            return  # 等待解碼期間訊息已被捲出視窗或刪除
+        if photos is None:
+            parent = canvas.master
+            canvas.destroy()
+            tk.Label(parent, text=f"[附件] {file_name}", bg="#2b2b2b", fg="white",
+                     font=self.message_font).pack(anchor="w")
             return
-        text_frame = ep["text_frame"]
-        parent = text_frame.master
-        attach_frame = None
-        for child in parent.winfo_children():
-            if child != text_frame:
-                attach_frame = child
-                break
-        text_frame.pack_forget()
-        if attach_frame:
-            entry = tk.Entry(parent, font=self.message_font, bg="#3a3a3a", fg="white")
-            entry.pack(before=attach_frame, anchor="w", padx=5, pady=2)
-        else:
-            entry = tk.Entry(parent, font=self.message_font, bg="#3a3a3a", fg="white")
-            entry.pack(anchor="w", padx=5, pady=2)
-        entry.insert(0, msg_data["text"])
-        entry.focus_set()
-        def finish_edit(event=None):
-            new_text = entry.get()
-            msg_data["text"] = new_text
-            entry.destroy()
-            for child in text_frame.winfo_children():
-                child.destroy()
-            segments = self.parse_text_with_secret(new_text)
-            for segtype, segtext in segments:
-                if segtype == "normal":
-                    lbl = tk.Label(text_frame, text=segtext, bg="#2b2b2b", fg="white", font=self.message_font)
-                    lbl.pack(side=tk.LEFT, anchor="w")
-                else:
-                    hidden_lbl = tk.Label(text_frame, text="點一下顯示", bg="#555555", fg="white", font=self.message_font)
-                    hidden_lbl.pack(side=tk.LEFT, anchor="w", padx=2)
-                    store = {"hidden": True, "secret_text": segtext}
-                    def on_toggle(e, lb=hidden_lbl, d=store):
-                        if d["hidden"]:
-                            lb.config(text=d["secret_text"], bg="#2b2b2b")
-                            d["hidden"] = False
-                        else:
-                            lb.config(text="點一下顯示", bg="#555555")
-                            d["hidden"] = True
-                    hidden_lbl.bind("<Button-1>", on_toggle)
-            if attach_frame:
-                text_frame.pack(before=attach_frame, anchor="w", padx=5, pady=2)
-            else:
-                text_frame.pack(anchor="w", padx=5, pady=2)
-            self.save_data()
-        def cancel_edit(event=None):
-            entry.destroy()
-            if attach_frame:
-                text_frame.pack(before=attach_frame, anchor="w", padx=5, pady=2)
-            else:
-                text_frame.pack(anchor="w", padx=5, pady=2)
-        entry.bind("<Return>", finish_edit)
-        entry.bind("<Escape>", cancel_edit)
-
-    def on_enter_message(self, msg_id):
-        ep = self.ephemeral_map.get(msg_id)
-        if ep:
-            ep["time_label"].pack(side=tk.LEFT, padx=5)
-            ep["edit_btn"].pack(side=tk.LEFT, padx=(10,5))
-            ep["del_btn"].pack(side=tk.LEFT, padx=5)
-
-    def on_leave_message(self, msg_id):
+        original_photo, hover_photo = photos
+        canvas.photos = photos
+        canvas.delete("all")
+        canvas.create_image(0, 0, anchor="nw", image=original_photo)
         ep = self.ephemeral_map.get(msg_id)
-        if ep:
-            ep["time_label"].pack_forget()
-            ep["edit_btn"].pack_forget()
-            ep["del_btn"].pack_forget()
-
-    def on_delete_message(self, msg_id):
-        if not messagebox.askyesno("確認刪除", "確定要刪除此訊息嗎？"):
+        if ep and ep.get("canvas_for_image") is canvas:
+            ep["original_photo"] = original_photo
+            ep["hover_photo"] = hover_photo
+        canvas.bind("<Enter>", lambda e: self.on_image_enter(msg_id, file_name))
+        canvas.bind("<Leave>", lambda e: self.on_image_leave(msg_id))
+
+    def show_attach_preview(self, file_hash, file_name, photos):
+        if self.attached_file_hash != file_hash:
+            return  # 預覽完成前已換了附件或已送出
+        if photos is None:
+            self.preview_label.config(text=file_name, image="")
             return
-        idx = None
-        for i, m in enumerate(self.messages_data):
-            if m["msg_id"] == msg_id:
-                idx = i
-                break
-        if idx is not None:
-            self.messages_data.pop(idx)
-        ep = self.ephemeral_map.pop(msg_id, None)
-        if ep:
-            ep["container"].destroy()
-        self.save_data()
+        self.attached_file_preview = photos[0]
+        self.preview_label.config(image=photos[0], text="")
 
     def make_alpha_image(self, pil_img, alpha=0.7):
         if pil_img.mode != "RGBA":
@@ -1445,25 +1764,37 @@ class ChatClientApp:
             self.search_listbox.place_forget()
 
     def on_search_var_changed(self, *args):
+        # 連續輸入時只在停頓後查詢一次
+        if self.search_after_id is not None:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(SEARCH_DEBOUNCE_MS, self.run_search)
+
+    def run_search(self):
+        self.search_after_id = None
         kw = self.search_var.get().strip()
         if not kw:
             self.search_listbox.place_forget()
             return
-        results = []
-        for m in self.messages_data:
-            if kw.lower() in m["text"].lower():
-                st = m["text"]
-                if len(st) > 30:
-                    st = st[:30] + "..."
-                results.append((m["msg_id"], st))
-        if not results:
-            self.search_listbox.place_forget()
-            return
+        try:
+            results = self.store.search(kw, SEARCH_RESULT_LIMIT)
+        except Exception as e:
+            print("搜尋失敗:", e)
+            results = []
         x = self.search_entry.winfo_rootx()
         y = self.search_entry.winfo_rooty() + self.search_entry.winfo_height()
         self.search_listbox.delete(0, tk.END)
-        for (mid, st) in results:
-            self.search_listbox.insert(tk.END, f"[{mid}] {st}")
+        self.search_result_ids = []
+        if results is None:
+            # 索引還在背景建立：顯示提示，稍後自動重查
+            self.search_listbox.insert(tk.END, "搜尋索引建立中…")
+            self.search_after_id = self.root.after(SEARCH_RETRY_MS, self.run_search)
+        elif not results:
+            self.search_listbox.place_forget()
+            return
+        else:
+            for (mid, st) in results:
+                self.search_result_ids.append(mid)
+                self.search_listbox.insert(tk.END, st)
         self.search_listbox.place(x=x, y=y, width=300, height=120)
         self.search_listbox.bind("<<ListboxSelect>>", self.on_search_select)
 
@@ -1471,18 +1802,24 @@ class ChatClientApp:
         if not self.search_listbox.curselection():
             return
         idx = self.search_listbox.curselection()[0]
-        line = self.search_listbox.get(idx)
-        try:
-            lb = line.index("[")
-            rb = line.index("]")
-            msg_id_str = line[lb+1:rb]
-            msg_id = int(msg_id_str)
-        except:
+        if idx >= len(self.search_result_ids):
             return
+        msg_id = self.search_result_ids[idx]
         self.search_listbox.place_forget()
         ep = self.ephemeral_map.get(msg_id)
         if not ep:
-            return
+            # 不在目前建立的範圍內：以該訊息為中心重新建立
+            while msg_id not in self.seq_by_id and self.load_older_messages():
+                pass
+            idx = self.message_index(msg_id)
+            if idx is None:
+                return
+            self.render_window(idx - RENDER_WINDOW // 2)
+            self.root.update_idletasks()
+            self.on_frame_configure()
+            ep = self.ephemeral_map.get(msg_id)
+            if not ep:
+                return
         container = ep["container"]
         y = container.winfo_rooty() - self.canvas.winfo_rooty() + self.canvas.canvasy(0)
         self.canvas.yview_moveto(y / self.canvas.bbox("all")[3])
@@ -1501,142 +1838,6 @@ class ChatClientApp:
                 user_label.configure(anchor="center")
             self.user_list_frame.lift()
 
-    def prepare_message(self, text):
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y/%m/%d")
-        time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
-        msg_data = {
-            "msg_id": msg_id,
-            "text": text,
-            "date": date_str,
-            "timestamp": time_str,
-            "file_path": None,
-            "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
-        }
-        if self.uploaded_file_id:
-            msg_data["file_chunked"] = True
-            msg_data["file_id"] = self.uploaded_file_id
-        elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
-                msg_data["is_image"] = True
-            try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
-            except Exception as e:
-                print("檔案編碼失敗:", e)
-        return json.dumps(msg_data, ensure_ascii=False)
-
-    def send_message(self, text):
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y/%m/%d")
-        time_str = now.strftime("%H:%M:%S")
-        msg_id = len(self.messages_data) + 1
-        sender_name = self.profile.get("name", "匿名")
-        sender_avatar = self.profile.get("avatar_data", "")
-        msg_data = {
-            "msg_id": msg_id,
-            "text": text,
-            "date": date_str,
-            "timestamp": time_str,
-            "file_path": None,
-            "is_image": False,
-            "sender_name": sender_name,
-            "sender_avatar": sender_avatar
-        }
-        if self.uploaded_file_id:
-            msg_data["file_chunked"] = True
-            msg_data["file_id"] = self.uploaded_file_id
-        elif self.attached_file_path:
-            msg_data["file_path"] = self.attached_file_path
-            if self.is_image_file(self.attached_file_path):
-                msg_data["is_image"] = True
-            try:
-                with open(self.attached_file_path, "rb") as f:
-                    file_bytes = f.read()
-                file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-                msg_data["file_data"] = file_b64
-                msg_data["file_name"] = os.path.basename(self.attached_file_path)
-            except Exception as e:
-                print("檔案編碼失敗:", e)
-        self.create_message_ui(msg_data)
-        self.messages_data.append(msg_data)
-        self.entry_var.set("")
-        self.preview_label.pack_forget()
-        self.preview_label.config(text="", image="")
-        self.attached_file_path = None
-        self.attached_file_preview = None
-        self.uploaded_file_id = None
-        self.scroll_to_bottom()
-        self.save_data()
-
-    def on_close(self):
-        self.save_data()
-        if self.socket:
-            self.socket.close()
-        self.root.destroy()
-
-    def load_data(self):
-        self.last_header_info = {}
-        if os.path.exists(self.data_path):
-            try:
-                with open(self.data_path, "r", encoding="utf-8") as f:
-                    saved_msgs = json.load(f)
-            except Exception as e:
-                print("讀取舊紀錄失敗:", e)
-                return
-            for m in saved_msgs:
-                self.create_message_ui(m)
-            self.messages_data = saved_msgs
-        self.scroll_to_bottom()
-
-    def save_data(self):
-        try:
-            with open(self.data_path, "w", encoding="utf-8") as f:
-                json.dump(self.messages_data, f, ensure_ascii=False, indent=2)
-            print("已儲存資料至", self.data_path)
-        except Exception as e:
-            print("儲存資料失敗:", e)
-
-    def attach_file(self):
-        orig_path = filedialog.askopenfilename()
-        if not orig_path:
-            return
-        # 所有檔案（包含影片）皆走附件上傳流程
-        filesize = os.path.getsize(orig_path)
-        if filesize > CHUNK_THRESHOLD:
-            self.cancel_upload = False
-            self.uploaded_file_id = os.path.basename(orig_path)
-            self.uploading = True
-            threading.Thread(target=self.send_file_in_chunks, args=(orig_path,), daemon=True).start()
-            messagebox.showinfo("上傳中", "超大檔案正在分塊上傳中，請稍候...")
-        else:
-            base_name = os.path.basename(orig_path)
-            new_path = os.path.join(self.attachments_dir, base_name)
-            if not self.copy_file_with_progress(orig_path, new_path):
-                return
-            self.attached_file_path = new_path
-            if self.is_image_file(new_path):
-                try:
-                    img = Image.open(new_path)
-                    img.thumbnail(self.image_thumbnail_size)
-                    preview_img = ImageTk.PhotoImage(img)
-                    self.attached_file_preview = preview_img
-                    self.preview_label.config(image=preview_img, text="")
-                except:
-                    self.preview_label.config(text=base_name, image="")
-            else:
-                self.preview_label.config(text=base_name, image="")
-            self.preview_label.pack(side=tk.TOP, fill=tk.X)
-
 if __name__ == "__main__":
     root = ThemedTk(theme="equilux")
     app = ChatClientApp(root)
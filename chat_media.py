@@ -0,0 +1,144 @@
+import os
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024  # 已解碼影像的記憶體預算
+IMAGE_WORKERS = 2                     # 背景解碼執行緒數
+
+def photo_cost(*photos):
+    # 以 寬 x 高 x 4 (RGBA) 估算 PhotoImage 佔用的記憶體
+    total = 0
+    for photo in photos:
+        if photo is not None:
+            total += photo.width() * photo.height() * 4
+    return total
+
+class ImageCache:
+    # 已解碼、已縮圖的影像 LRU 快取，key 為 (種類, 內容雜湊, 尺寸)
+    # 被淘汰的影像若仍有元件引用（label.image / ephemeral_map）不會消失，只是下次需要重新解碼
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, cost)
+        self.total_bytes = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, cost):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old[1]
+        if cost > self.max_bytes:
+            return value
+        self.entries[key] = (value, cost)
+        self.total_bytes += cost
+        while self.total_bytes > self.max_bytes:
+            _, (_, old_cost) = self.entries.popitem(last=False)
+            self.total_bytes -= old_cost
+        return value
+
+class ThumbnailStore:
+    # 磁碟上的縮圖快取：<附件雜湊>_<寬>x<高>.png 與對應的 _hover.png，重開程式不必再解碼原圖
+    # 只快取內容定址的圖片（key 為 SHA-256），以路徑識別的舊附件內容可能改變，不落地
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def paths_for(self, digest, size):
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            return None
+        base = os.path.join(self.directory, f"{digest}_{size[0]}x{size[1]}")
+        return base + ".png", base + "_hover.png"
+
+    def load(self, digest, size):
+        paths = self.paths_for(digest, size)
+        if not paths or not os.path.exists(paths[0]) or not os.path.exists(paths[1]):
+            return None
+        try:
+            images = []
+            for path in paths:
+                img = Image.open(path)
+                img.load()
+                images.append(img)
+            return tuple(images)
+        except Exception as e:
+            print("讀取縮圖快取失敗:", e)
+            return None
+
+    def save(self, digest, size, thumb, hover):
+        paths = self.paths_for(digest, size)
+        if not paths:
+            return
+        try:
+            for img, path in ((thumb, paths[0]), (hover, paths[1])):
+                if img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+                    img = img.convert("RGBA")
+                tmp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}.png")
+                img.save(tmp_path, "PNG")
+                os.replace(tmp_path, path)
+        except Exception as e:
+            print("寫入縮圖快取失敗:", e)
+
+class ImageLoader:
+    # 在背景執行緒解碼/縮圖，完成後透過 root.after 回到 Tk 執行緒建立 PhotoImage 並放進快取
+    # decode 在背景執行，只能碰 PIL；build 在 Tk 執行緒執行，回傳 (value, cost)
+    def __init__(self, root, cache, workers=IMAGE_WORKERS):
+        self.root = root
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self.pending = {}  # key -> 等待中的 callback，同一張圖只解碼一次
+        self.closed = False
+
+    def request(self, key, decode, build, callback):
+        # callback(value) 一定在 Tk 執行緒呼叫；失敗時 value 為 None
+        value = self.cache.get(key)
+        if value is not None:
+            callback(value)
+            return
+        waiters = self.pending.get(key)
+        if waiters is not None:
+            waiters.append(callback)
+            return
+        self.pending[key] = [callback]
+        self.pool.submit(self.run, key, decode, build)
+
+    def run(self, key, decode, build):
+        if self.closed:
+            return
+        try:
+            result, error = decode(), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            self.root.after(0, self.finish, key, result, error, build)
+        except Exception:
+            pass  # 視窗已關閉
+
+    def finish(self, key, result, error, build):
+        callbacks = self.pending.pop(key, [])
+        value = None
+        if error is None and result is not None:
+            try:
+                value, cost = build(result)
+                self.cache.put(key, value, cost)
+            except Exception as e:
+                error = e
+        if error is not None:
+            print("影像載入失敗:", error)
+        for callback in callbacks:
+            try:
+                callback(value)
+            except Exception as e:
+                print("影像顯示失敗:", e)
+
+    def shutdown(self):
+        self.closed = True
+        self.pending.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
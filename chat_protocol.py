@@ -0,0 +1,128 @@
+import base64
+import json
+import struct
+
+# 連線建立後，用戶端先送出一行 hello；伺服器回覆相同的 hello 後，雙方改用二進位訊框。
+# 沒回覆（舊版伺服器）就維持原本以 \n 分隔的 JSON 文字格式。
+PROTOCOL_NAME = "binary"
+PROTOCOL_VERSION = 1
+
+# 二進位訊框：[metadata 長度][payload 長度] + JSON metadata + 原始 payload bytes
+FRAME_HEADER = struct.Struct("!II")
+MAX_META_BYTES = 1024 * 1024
+MAX_PAYLOAD_BYTES = 64 * 1024 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+# role 為 "data" 的連線只用來上傳大檔分塊，伺服器不會轉送訊息給它
+# session 是用戶端自己產生的識別碼，聊天連線與資料連線帶同一個，伺服器才知道上傳的分塊不必轉回給上傳者
+ROLE_CHAT = "chat"
+ROLE_DATA = "data"
+
+def hello_line(role=None, session=None, features=None):
+    # 伺服器回覆的 hello 以 features 告知額外支援的功能（例如 "blobs"）
+    hello = {"type": "hello", "protocol": PROTOCOL_NAME, "version": PROTOCOL_VERSION}
+    if role:
+        hello["role"] = role
+    if session:
+        hello["session"] = session
+    if features:
+        hello["features"] = list(features)
+    return (json.dumps(hello) + "\n").encode("utf-8")
+
+def parse_hello(line):
+    # 是相容的 hello 就回傳 dict，否則回傳 None
+    line = line.strip()
+    if not line.startswith(b"{") or b'"hello"' not in line:
+        return None
+    try:
+        msg = json.loads(line)
+    except ValueError:
+        return None
+    if (isinstance(msg, dict) and msg.get("type") == "hello"
+            and msg.get("protocol") == PROTOCOL_NAME and msg.get("version") == PROTOCOL_VERSION):
+        return msg
+    return None
+
+def is_hello_line(line):
+    return parse_hello(line) is not None
+
+def encode_meta(meta):
+    if isinstance(meta, dict):
+        return json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    return meta
+
+def frame_header(meta_bytes, payload_len):
+    # payload 另外寫出，避免為了拼接訊框而複製大型附件
+    return FRAME_HEADER.pack(len(meta_bytes), payload_len) + meta_bytes
+
+def encode_frame(meta, payload=b""):
+    meta_bytes = encode_meta(meta)
+    return frame_header(meta_bytes, len(payload)) + payload
+
+def iter_frame_bounds(buffer):
+    # 逐一產生 buffer 開頭完整訊框的 (meta 起點, payload 起點, 結尾)，不複製資料
+    pos = 0
+    size = len(buffer)
+    while size - pos >= FRAME_HEADER.size:
+        meta_len, payload_len = FRAME_HEADER.unpack_from(buffer, pos)
+        if meta_len > MAX_META_BYTES or payload_len > MAX_PAYLOAD_BYTES:
+            raise ProtocolError(f"訊框過大: meta={meta_len} payload={payload_len}")
+        meta_start = pos + FRAME_HEADER.size
+        payload_start = meta_start + meta_len
+        end = payload_start + payload_len
+        if end > size:
+            return
+        yield meta_start, payload_start, end
+        pos = end
+
+def complete_frames_length(buffer):
+    # buffer 開頭完整訊框的總長度與數量
+    consumed = 0
+    count = 0
+    for _, _, end in iter_frame_bounds(buffer):
+        consumed = end
+        count += 1
+    return consumed, count
+
+def split_frames(buffer):
+    # 解析出 buffer 開頭所有完整訊框，回傳 ([(meta, payload), ...], 已消耗的位元組數)
+    frames = []
+    consumed = 0
+    with memoryview(buffer) as view:
+        for meta_start, payload_start, end in iter_frame_bounds(buffer):
+            frames.append((bytes(view[meta_start:payload_start]), bytes(view[payload_start:end])))
+            consumed = end
+    return frames, consumed
+
+def split_lines(buffer, scan_pos=0):
+    # 文字格式：從 bytearray 開頭取出所有完整的行並就地刪除，回傳 ([line_bytes, ...], 新的 scan_pos)
+    # 只從 scan_pos 之後找 \n，先切行再解碼，多位元組 UTF-8 字元跨 recv 邊界也不會被切壞
+    end = buffer.rfind(b"\n", scan_pos)
+    if end < 0:
+        return [], len(buffer)
+    with memoryview(buffer) as view:
+        lines = bytes(view[:end]).split(b"\n")
+    del buffer[:end + 1]
+    return lines, len(buffer)  # 剩下的部分已確定沒有 \n
+
+def frame_to_text_line(meta_bytes, payload):
+    # 轉給只懂文字格式的舊版用戶：payload 以 base64 放回 payload_field 指定的欄位
+    if not payload:
+        return meta_bytes + b"\n"
+    meta = json.loads(meta_bytes)
+    field = meta.pop("payload_field", "data")
+    meta[field] = base64.b64encode(payload).decode("ascii")
+    return json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def text_line_to_frame(line):
+    return encode_frame(line.rstrip(b"\r\n"))
+
+def meta_to_text_line(meta, payload=b""):
+    # 文字模式下送出：把 payload 併回 metadata
+    if payload:
+        meta = dict(meta)
+        field = meta.pop("payload_field", "data")
+        meta[field] = base64.b64encode(payload).decode("ascii")
+    return (json.dumps(meta, ensure_ascii=False) + "\n").encode("utf-8")
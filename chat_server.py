@@ -1,56 +1,535 @@
-import socket
-import threading
+import asyncio
+import json
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import chat_protocol
+import chat_transfer
+from chat_store import AttachmentStore
 
 HOST = "0.0.0.0"  # 監聽所有網路介面
 PORT = 12345      # 你可以自行調整埠號
+BACKLOG = 1024    # listen 佇列長度，大量用戶同時連線時避免被拒
+
+# 每個連線的送出佇列上限；超過時依 OVERFLOW_POLICY 處理
+SEND_QUEUE_MAX_FRAMES = 1024
+SEND_QUEUE_MAX_BYTES = 8 * 1024 * 1024
+# "drop_oldest"：丟掉最舊的待送資料 / "disconnect"：直接斷開慢速用戶 / "coalesce"：合併積壓資料，位元組仍超限才斷線
+OVERFLOW_POLICY = "drop_oldest"
+WRITE_BATCH_BYTES = 256 * 1024  # 寫入端每次合併送出的最大量
+# 附件下載的分塊走另一條低優先權佇列：聊天訊息永遠先送，分塊只在聊天佇列清空時送出
+BULK_QUEUE_MAX_BYTES = 32 * 1024 * 1024  # 超過就丟棄分塊，由續傳機制補送
+BULK_QUEUE_HIGH = 4 * 1024 * 1024        # 下載端積壓超過此量就暫停讀檔，等它消化
+
+# 上傳的附件以內容雜湊存在伺服器，只轉送帶雜湊的訊息，用戶端需要時再用 file_get 下載
+BLOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_blobs")
+FEATURE_BLOBS = "blobs"
+PART_MAX_AGE = 24 * 60 * 60        # 未完成的上傳超過這麼久沒有進展就刪除
+PART_EXPIRE_INTERVAL = 60 * 60
+# 分塊寫檔與雜湊計算不佔用事件迴圈；單一執行緒保證同一檔案的操作依序進行
+blob_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blobs")
+blobs = None
+blob_receiver = None
+
+READ_SIZE = 65536                  # 每次從 socket 讀取的量
+MAX_FRAME_BYTES = 16 * 1024 * 1024 # 單一訊框（以 \n 結尾）的長度上限，超過視為異常連線
+
+clients = set()   # 所有連線中的 ClientConnection（單一事件迴圈內使用，不需要鎖）
+# 各使用者最後一次公布的個人資料（含頭像），新用戶協商完成後補送，訊息本身只帶頭像雜湊
+profiles = OrderedDict()
+MAX_PROFILES = 1024
+
+def raise_fd_limit():
+    # 上萬條連線需要足夠的檔案描述符；Windows 沒有 resource 模組
+    try:
+        import resource
+    except ImportError:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        print("調整檔案描述符上限失敗:", e)
+
+class FileSlice:
+    # 送出佇列中的「訊框標頭 + 檔案片段」：寫出時以 loop.sendfile 直接由檔案送到 socket，
+    # 平台支援時走核心的 zero-copy（os.sendfile），不經過 Python 的記憶體
+    def __init__(self, header, file, offset, count, close_after=False):
+        self.header = header
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.close_after = close_after  # 同一個下載的最後一片負責關檔
+
+    def __len__(self):
+        return len(self.header) + self.count
+
+    def release(self):
+        if self.close_after:
+            self.file.close()
+
+class ClientConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.binary = False   # 完成 hello 協商後改用二進位訊框
+        self.greeted = False  # 是否已檢查過第一行是否為 hello
+        self.role = chat_protocol.ROLE_CHAT
+        self.session = None   # hello 帶來的用戶端識別碼，同一個用戶端的聊天與資料連線相同
+        self.bulk_queue = deque()
+        self.bulk_bytes = 0
+        self.bulk_dropped = 0
+        self.bulk_drained = asyncio.Event()
+        self.transfers = []   # 本次讀取中要由伺服器自己處理的檔案傳輸訊息 (meta, payload)
+        self.uploads = set()  # 這條連線送過 manifest、尚未完成的 file_id，離線時釋放
+        self.tasks = set()    # 進行中的下載（serve_blob），保留參照直到結束
 
-clients = []
-clients_lock = threading.Lock()
-
-def broadcast(message, sender_socket):
-    with clients_lock:
-        for client in clients:
-            # 不傳給發送者（或也可傳送回去，依需求而定）
-            if client != sender_socket:
-                try:
-                    client.sendall(message)
-                except Exception as e:
-                    print("傳送訊息失敗:", e)
-                    clients.remove(client)
-
-def handle_client(client_socket, addr):
-    print("新連線:", addr)
-    with client_socket:
-        while True:
+    def start_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("檔案傳送失敗:", self.addr, task.exception())
+
+    def enqueue(self, data, bulk=False):
+        if self.closed:
+            return
+        if bulk:
+            if self.bulk_bytes + len(data) > BULK_QUEUE_MAX_BYTES:
+                self.bulk_dropped += 1
+                if isinstance(data, FileSlice):
+                    data.release()
+                return
+            self.bulk_queue.append(data)
+            self.bulk_bytes += len(data)
+            self.wakeup.set()
+            return
+        if len(self.queue) >= SEND_QUEUE_MAX_FRAMES or self.queued_bytes + len(data) > SEND_QUEUE_MAX_BYTES:
+            if not self.handle_overflow(data):
+                return
+        self.queue.append(data)
+        self.queued_bytes += len(data)
+        self.wakeup.set()
+
+    def handle_overflow(self, data):
+        # 回傳 True 表示 data 仍可放入佇列
+        if OVERFLOW_POLICY == "disconnect":
+            print("送出佇列已滿，中斷慢速連線:", self.addr)
+            self.close()
+            return False
+        if OVERFLOW_POLICY == "coalesce":
+            if self.queued_bytes + len(data) > SEND_QUEUE_MAX_BYTES:
+                print("積壓資料超過上限，中斷慢速連線:", self.addr)
+                self.close()
+                return False
+            merged = b"".join(self.queue)
+            self.queue.clear()
+            self.queue.append(merged)
+            return True
+        if len(data) > SEND_QUEUE_MAX_BYTES:
+            self.dropped += 1
+            return False
+        while self.queue and (len(self.queue) >= SEND_QUEUE_MAX_FRAMES
+                              or self.queued_bytes + len(data) > SEND_QUEUE_MAX_BYTES):
+            old = self.queue.popleft()
+            self.queued_bytes -= len(old)
+            self.dropped += 1
+        return True
+
+    async def write_loop(self):
+        try:
+            while True:
+                while not self.queue and not self.bulk_queue:
+                    if self.closed:
+                        return
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                batch = []
+                size = 0
+                if self.queue:
+                    while self.queue and size < WRITE_BATCH_BYTES:
+                        data = self.queue.popleft()
+                        batch.append(data)
+                        size += len(data)
+                    self.queued_bytes -= size
+                else:
+                    while self.bulk_queue and size < WRITE_BATCH_BYTES:
+                        data = self.bulk_queue.popleft()
+                        size += len(data)
+                        if isinstance(data, FileSlice):
+                            await self.send_file_slice(batch, data)
+                            batch = []
+                            break  # 每送完一片就回頭檢查聊天佇列
+                        batch.append(data)
+                    self.bulk_bytes = max(0, self.bulk_bytes - size)
+                    if self.bulk_bytes <= BULK_QUEUE_HIGH:
+                        self.bulk_drained.set()
+                    if not batch:
+                        continue
+                self.writer.writelines(batch)
+                # 只有這個連線自己的寫入端會在這裡等待，不影響其他用戶
+                await self.writer.drain()
+        except Exception as e:
+            print("傳送訊息失敗:", e)
+        finally:
+            self.close()
+
+    async def send_file_slice(self, batch, item):
+        try:
+            batch.append(item.header)
+            self.writer.writelines(batch)
+            await self.writer.drain()
+            await asyncio.get_running_loop().sendfile(self.writer.transport, item.file, item.offset, item.count)
+        finally:
+            item.release()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        for item in self.bulk_queue:
+            if isinstance(item, FileSlice):
+                item.release()
+        self.bulk_queue.clear()
+        self.bulk_bytes = 0
+        self.wakeup.set()
+        self.bulk_drained.set()
+        clients.discard(self)
+        self.writer.close()
+        if self.dropped:
+            print(f"{self.addr} 因佇列溢出丟棄 {self.dropped} 筆資料")
+        if self.bulk_dropped:
+            print(f"{self.addr} 因分塊佇列溢出丟棄 {self.bulk_dropped} 個分塊")
+
+class RelayBatch:
+    # 一次讀取中解析出的所有訊框；依接收端的格式各轉換一次，再共用給所有同格式的用戶
+    def __init__(self, binary, raw):
+        self.raw = raw
+        self.encoded = {binary: raw}
+
+    def encode(self, binary):
+        data = self.encoded.get(binary)
+        if data is None:
+            if binary:
+                data = b"".join(chat_protocol.text_line_to_frame(line)
+                                for line in self.raw.splitlines(keepends=True))
+            else:
+                frames, _ = chat_protocol.split_frames(self.raw)
+                data = b"".join(chat_protocol.frame_to_text_line(meta, payload)
+                                for meta, payload in frames)
+            self.encoded[binary] = data
+        return data
+
+def broadcast(batch, sender):
+    for client in list(clients):
+        # 不傳給發送者（或也可傳送回去，依需求而定）
+        if client is not sender and not (sender.session and client.session == sender.session):
             try:
-                data = client_socket.recv(1024)
+                client.enqueue(batch.encode(client.binary))
+            except Exception as e:
+                print("訊息格式轉換失敗:", e)
+
+def parse_profile(meta_bytes):
+    if b'"profile"' not in meta_bytes:
+        return None
+    try:
+        meta = json.loads(meta_bytes)
+    except ValueError:
+        return None
+    if isinstance(meta, dict) and meta.get("type") == "profile":
+        return meta
+    return None
+
+def remember_profile(meta, batch):
+    key = meta.get("name") or meta.get("avatar_hash")
+    if not key:
+        return
+    profiles.pop(key, None)
+    profiles[key] = batch
+    while len(profiles) > MAX_PROFILES:
+        profiles.popitem(last=False)
+
+def collect_profiles(binary, raw):
+    if b'"profile"' not in raw:
+        return
+    if binary:
+        for meta_start, payload_start, end in chat_protocol.iter_frame_bounds(raw):
+            meta = parse_profile(raw[meta_start:payload_start])
+            if meta:
+                remember_profile(meta, RelayBatch(True, raw[meta_start - chat_protocol.FRAME_HEADER.size:end]))
+    else:
+        for line in raw.splitlines(keepends=True):
+            meta = parse_profile(line)
+            if meta:
+                remember_profile(meta, RelayBatch(False, line))
+
+def send_to(conn, meta, payload=b"", bulk=False):
+    if conn.binary:
+        conn.enqueue(chat_protocol.encode_frame(meta, payload), bulk)
+    else:
+        conn.enqueue(chat_protocol.meta_to_text_line(meta, payload), bulk)
+
+def take_transfers(conn, binary, raw):
+    # 檔案傳輸訊息交給伺服器自己處理（放進 conn.transfers），回傳其餘要轉送的資料與筆數
+    kept = []
+    if binary:
+        with memoryview(raw) as view:
+            for meta_start, payload_start, end in chat_protocol.iter_frame_bounds(raw):
+                msg, kind = chat_transfer.parse_transfer_message(raw[meta_start:payload_start])
+                if msg is None:
+                    kept.append(raw[meta_start - chat_protocol.FRAME_HEADER.size:end])
+                else:
+                    conn.transfers.append((kind, msg, bytes(view[payload_start:end])))
+    else:
+        for line in raw.splitlines(keepends=True):
+            msg, kind = chat_transfer.parse_transfer_message(line)
+            if msg is None:
+                kept.append(line)
+            else:
+                conn.transfers.append((kind, msg, chat_transfer.pop_text_payload(kind, msg)))
+    return b"".join(kept), len(kept)
+
+async def handle_transfers(conn):
+    # 依收到的順序處理；上傳的分塊要等寫入完成才讀下一批，讀取速度自然跟著磁碟速度
+    loop = asyncio.get_running_loop()
+    transfers, conn.transfers = conn.transfers, []
+    for kind, msg, payload in transfers:
+        try:
+            if kind == "file_chunk":
+                info = await loop.run_in_executor(blob_executor, blob_receiver.add_chunk, msg, payload)
+                if info:
+                    print(f"附件已儲存: {info['file_name']} {info['file_hash']} ({info['file_size']} bytes)")
+            elif kind == "file_manifest":
+                status = await loop.run_in_executor(blob_executor, blob_receiver.add_manifest, msg, payload)
+                if status:
+                    if status["missing"]:
+                        conn.uploads.add(status["file_id"])
+                    send_to(conn, status)
+            elif kind == "file_get":
+                conn.start_task(serve_blob(conn, msg))
+            elif kind == "file_sync":
+                # 前面的分塊都已寫入才會處理到這裡；回覆後送出端才送下一輪 manifest
+                send_to(conn, {"type": "file_sync", "file_id": msg.get("file_id")})
+        except Exception as e:
+            print("處理檔案傳輸失敗:", conn.addr, e)
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+def requested_chunks(msg, file_size, chunk_size, total_chunks):
+    # file_get 可用 missing（分塊範圍，續傳用）或 offset/length（位元組範圍）指定只要部分內容
+    if msg.get("missing") is not None:
+        return sorted(chat_transfer.ranges_to_indices(msg["missing"], total_chunks))
+    if msg.get("offset") is not None:
+        start = max(0, int(msg["offset"]))
+        length = int(msg.get("length") or max(0, file_size - start))
+        if length <= 0 or start >= file_size:
+            return []
+        return range(start // chunk_size, min(total_chunks, (start + length - 1) // chunk_size + 1))
+    return range(total_chunks)
+
+async def serve_blob(conn, msg):
+    # 以分塊送出附件；分塊格式與上傳相同，用戶端可沿用同一套重組與續傳邏輯
+    # 二進位連線的分塊內容交給寫入端以 sendfile 送出；文字連線仍需讀進來轉成 base64
+    file_hash = str(msg.get("file_hash") or "")
+    file_id = chat_transfer.blob_file_id(file_hash)
+    path = blobs.find(file_hash) if len(file_hash) == 64 and file_hash.isalnum() else None
+    f = None
+    if path:
+        try:
+            f = open(path, "rb")
+            file_size = os.fstat(f.fileno()).st_size
+        except OSError as e:
+            print("讀取附件失敗:", file_hash, e)
+            if f:
+                f.close()
+            f = None
+    if f is None:
+        send_to(conn, {"type": "file_status", "file_id": file_id, "file_hash": file_hash, "available": False})
+        return
+    loop = asyncio.get_running_loop()
+    chunk_size = chat_transfer.choose_chunk_size(file_size)
+    total_chunks = chat_transfer.chunk_count(file_size, chunk_size)
+    try:
+        indices = requested_chunks(msg, file_size, chunk_size, total_chunks)
+    except (TypeError, ValueError):
+        print("下載範圍格式錯誤:", conn.addr)
+        f.close()
+        return
+    handed_off = False  # 最後一片排進佇列後由寫入端關檔
+    try:
+        for pos, index in enumerate(indices):
+            while conn.bulk_bytes > BULK_QUEUE_HIGH and not conn.closed:
+                conn.bulk_drained.clear()
+                await conn.bulk_drained.wait()
+            if conn.closed:
+                return
+            offset = index * chunk_size
+            count = min(chunk_size, file_size - offset)
+            meta = {
+                "file_chunk": True,
+                "file_id": file_id,
+                "file_hash": file_hash,
+                "file_name": msg.get("file_name") or file_hash,
+                "chunk_index": index,
+                "chunk_size": chunk_size,
+                "total_chunks": total_chunks,
+                "payload_field": "data"
+            }
+            if conn.binary:
+                last = pos == len(indices) - 1
+                header = chat_protocol.frame_header(chat_protocol.encode_meta(meta), count)
+                conn.enqueue(FileSlice(header, f, offset, count, close_after=last), bulk=True)
+                handed_off = last
+            else:
+                data = await loop.run_in_executor(None, read_at, f, offset, count)
+                send_to(conn, meta, data, bulk=True)
+    finally:
+        if not handed_off:
+            f.close()
+
+def relay_text(conn, buffer, scan_pos):
+    # 回傳新的 scan_pos；None 表示應中斷連線
+    end = buffer.rfind(b"\n", scan_pos)
+    if end < 0:
+        if len(buffer) > MAX_FRAME_BYTES:
+            print("訊框過長，中斷連線:", conn.addr)
+            return None
+        return len(buffer)
+    if not conn.greeted:
+        conn.greeted = True
+        first_end = buffer.find(b"\n")
+        hello = chat_protocol.parse_hello(bytes(buffer[:first_end]))
+        if hello:
+            del buffer[:first_end + 1]
+            conn.enqueue(chat_protocol.hello_line(features=[FEATURE_BLOBS]))
+            conn.binary = True
+            session = hello.get("session")
+            conn.session = session if isinstance(session, str) else None
+            if hello.get("role") == chat_protocol.ROLE_DATA:
+                # 資料連線只負責上傳，不接收任何轉送
+                conn.role = chat_protocol.ROLE_DATA
+                clients.discard(conn)
+                print("資料連線:", conn.addr)
+            else:
+                for batch in profiles.values():
+                    conn.enqueue(batch.encode(True))
+                print("改用二進位協定:", conn.addr)
+            return 0 if relay_binary(conn, buffer) else None
+    # 本次讀到的所有完整訊框合併成一筆，對每個用戶只寫入一次
+    frames = bytes(buffer[:end + 1])
+    del buffer[:end + 1]
+    count = frames.count(b"\n")
+    if any(marker in frames for marker in chat_transfer.TRANSFER_MARKERS_BYTES):
+        frames, count = take_transfers(conn, False, frames)
+        if not count:
+            return len(buffer)
+    print(f"從 {conn.addr} 收到 {count} 筆訊息，共 {len(frames)} bytes")
+    collect_profiles(False, frames)
+    broadcast(RelayBatch(False, frames), conn)
+    return len(buffer)
+
+def relay_binary(conn, buffer):
+    # 回傳 False 表示訊框不合法，應中斷連線
+    try:
+        consumed, count = chat_protocol.complete_frames_length(buffer)
+    except chat_protocol.ProtocolError as e:
+        print("訊框錯誤，中斷連線:", conn.addr, e)
+        return False
+    if not count:
+        return True
+    raw = bytes(buffer[:consumed])
+    del buffer[:consumed]
+    if conn.role == chat_protocol.ROLE_DATA or any(marker in raw for marker in chat_transfer.TRANSFER_MARKERS_BYTES):
+        raw, count = take_transfers(conn, True, raw)
+        if not count:
+            return True
+        if conn.role == chat_protocol.ROLE_DATA:
+            # 資料連線只能上傳檔案，其他訊框不轉送
+            print(f"資料連線 {conn.addr} 送來 {count} 筆非檔案傳輸訊息，已丟棄")
+            return True
+    print(f"從 {conn.addr} 收到 {count} 筆訊息，共 {len(raw)} bytes")
+    collect_profiles(True, raw)
+    broadcast(RelayBatch(True, raw), conn)
+    return True
+
+async def handle_client(reader, writer):
+    conn = ClientConnection(reader, writer)
+    print("新連線:", conn.addr)
+    clients.add(conn)
+    write_task = asyncio.create_task(conn.write_loop())
+    buffer = bytearray()  # 重複使用的接收緩衝區
+    scan_pos = 0          # 已掃描過、確定沒有 \n 的位置，避免重複搜尋
+    try:
+        while not conn.closed:
+            try:
+                data = await reader.read(READ_SIZE)
                 if not data:
                     break
-                print(f"從 {addr} 收到: {data.decode('utf-8')}")
-                broadcast(data, client_socket)
+                buffer += data
+                if conn.binary:
+                    if not relay_binary(conn, buffer):
+                        break
+                else:
+                    scan_pos = relay_text(conn, buffer, scan_pos)
+                    if scan_pos is None:
+                        break
+                if conn.transfers:
+                    await handle_transfers(conn)
             except Exception as e:
                 print("連線錯誤:", e)
                 break
-    with clients_lock:
-        if client_socket in clients:
-            clients.remove(client_socket)
-    print("連線關閉:", addr)
+    finally:
+        conn.close()
+        if conn.uploads:
+            # 未完成的上傳不佔記憶體與檔案代碼，進度留在磁碟等同一個 file_id 回來續傳
+            await asyncio.get_running_loop().run_in_executor(blob_executor, blob_receiver.release, conn.uploads)
+        await write_task
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        print("連線關閉:", conn.addr)
 
-def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen()
+async def expire_partial_uploads():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(blob_executor, blob_receiver.expire, PART_MAX_AGE)
+        except Exception as e:
+            print("清除過期上傳失敗:", e)
+        await asyncio.sleep(PART_EXPIRE_INTERVAL)
+
+async def serve():
+    global blobs, blob_receiver
+    blobs = AttachmentStore(BLOB_DIR)
+    blob_receiver = chat_transfer.ChunkReceiver(blobs, require_manifest=True)
+    expire_task = asyncio.create_task(expire_partial_uploads())  # 保留參照，避免被回收
+    server = await asyncio.start_server(handle_client, HOST, PORT, backlog=BACKLOG)
     print(f"聊天伺服器啟動：{HOST}:{PORT}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    raise_fd_limit()
     try:
-        while True:
-            client_socket, addr = server_socket.accept()
-            with clients_lock:
-                clients.append(client_socket)
-            threading.Thread(target=handle_client, args=(client_socket, addr), daemon=True).start()
+        asyncio.run(serve())
     except KeyboardInterrupt:
         print("伺服器關閉")
-    finally:
-        server_socket.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,670 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from array import array
+
+# 超過這個數量的失效紀錄（已刪除或被編輯覆蓋）且多於有效訊息時，關閉前壓縮日誌
+COMPACT_MIN_DEAD = 1000
+REVERSE_READ_SIZE = 65536  # 由檔尾往前讀取日誌時每次讀入的量
+
+class AttachmentStore:
+    # 內容定址的附件庫：檔名就是內容的 SHA-256，相同檔案只存一份；訊息只記錄雜湊
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, file_hash):
+        return os.path.join(self.directory, file_hash)
+
+    def find(self, file_hash):
+        path = self.path_for(file_hash)
+        return path if os.path.exists(path) else None
+
+    def temp_path(self):
+        return os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+
+    def commit_temp(self, tmp_path, file_hash):
+        # 已有相同內容就丟掉暫存檔
+        path = self.path_for(file_hash)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+
+    def put_bytes(self, data):
+        file_hash = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.path_for(file_hash)):
+            tmp_path = self.temp_path()
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            self.commit_temp(tmp_path, file_hash)
+        return file_hash
+
+    def externalize(self, msg):
+        # 舊紀錄內嵌的 base64 附件移到附件庫，改為記錄雜湊；回傳是否有變更
+        if not msg.get("file_data"):
+            return False
+        data = base64.b64decode(msg.pop("file_data"))
+        msg["file_hash"] = self.put_bytes(data)
+        msg["file_size"] = len(data)
+        msg.pop("file_path", None)
+        return True
+
+def snippet(text, width=30):
+    return text[:width] + "..." if len(text) > width else text
+
+def legacy_message_id(key):
+    return f"legacy-{key}"
+
+class LegacyIds:
+    # 舊版的 msg_id 是 len+1 流水號，可能重複。讀取時把每筆舊訊息換成唯一的字串編號
+    # （以紀錄位置命名，每次讀取都相同），原本的數字留在 legacy_id；
+    # 舊紀錄中以數字編號寫的編輯／刪除，套用在該編號最近一次新增、仍有效的訊息
+    def __init__(self):
+        self.ids = {}  # 數字編號 -> [唯一編號, ...]（依出現順序）
+
+    def assign(self, msg, key):
+        msg_id = msg.get("msg_id")
+        if isinstance(msg_id, str):
+            return msg_id
+        msg["legacy_id"] = msg_id
+        msg["msg_id"] = legacy_message_id(key)
+        self.ids.setdefault(msg_id, []).append(msg["msg_id"])
+        return msg["msg_id"]
+
+    def resolve(self, msg_id, remove=False):
+        if isinstance(msg_id, str):
+            return msg_id
+        ids = self.ids.get(msg_id)
+        if not ids:
+            return None
+        return ids.pop() if remove else ids[-1]
+
+def assign_legacy_ids(messages):
+    legacy = LegacyIds()
+    for i, msg in enumerate(messages):
+        legacy.assign(msg, i)
+    return messages
+
+class SearchIndex:
+    # 字元 unigram + bigram 倒排索引。中文沒有空白可斷詞，所以用查詢字串中最少見的 gram
+    # 取得候選訊息，再以子字串比對確認，結果與逐筆 `kw in text` 相同。
+    # posting 只追加（4 bytes 的 array 節省記憶體），編輯與刪除後的舊項目在比對時自然被排除。
+    # 索引不保存訊息內容，只記錄目前文字所在紀錄的位元組位置，比對時再由 read_text 從檔案讀回。
+    def __init__(self):
+        self.postings = {}          # gram -> array of seq
+        self.msg_ids = []           # seq -> msg_id
+        self.offsets = array("q")   # seq -> 目前文字所在紀錄的位置，-1 表示已刪除
+        self.seqs = {}              # msg_id -> 仍有效訊息的 seq
+        self.legacy = LegacyIds()
+        self.live = 0
+
+    def grams(self, text):
+        text = text.lower()
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+
+    def add_postings(self, seq, grams):
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("I")
+            posting.append(seq)
+
+    def add_message(self, msg_id, text, offset):
+        seq = len(self.msg_ids)
+        self.msg_ids.append(msg_id)
+        self.offsets.append(offset)
+        self.seqs[msg_id] = seq
+        self.live += 1
+        self.add_postings(seq, self.grams(text))
+
+    def update_message(self, msg_id, text, offset):
+        seq = self.seqs.get(msg_id)
+        if seq is None:
+            return
+        self.offsets[seq] = offset
+        # 舊文字沒有保存；重複的 posting 在搜尋時去除
+        self.add_postings(seq, self.grams(text))
+
+    def remove_message(self, msg_id):
+        seq = self.seqs.pop(msg_id, None)
+        if seq is not None:
+            self.offsets[seq] = -1
+            self.live -= 1
+
+    def apply_record(self, record, offset):
+        op = record.get("op")
+        if op == "add":
+            msg = record["msg"]
+            self.add_message(self.legacy.assign(msg, offset), msg.get("text", ""), offset)
+        elif op == "edit":
+            self.update_message(self.legacy.resolve(record["msg_id"]), record["text"], offset)
+        elif op == "delete":
+            self.remove_message(self.legacy.resolve(record["msg_id"], remove=True))
+
+    def search(self, keyword, limit, read_text):
+        kw = keyword.lower()
+        if len(kw) == 1:
+            query_grams = [kw]
+        else:
+            query_grams = [kw[i:i + 2] for i in range(len(kw) - 1)]
+        postings = []
+        for gram in query_grams:
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            postings.append(posting)
+        rarest = min(postings, key=len)
+        results = []
+        seen = set()
+        # 由新到舊，湊滿 limit 筆就停止
+        for seq in reversed(rarest):
+            if seq in seen:
+                continue
+            seen.add(seq)
+            offset = self.offsets[seq]
+            if offset < 0:
+                continue
+            text = read_text(offset)
+            if kw in text.lower():
+                results.append((self.msg_ids[seq], snippet(text)))
+                if len(results) >= limit:
+                    break
+        return results
+
+def iter_records(f):
+    for line in f:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # 寫到一半中斷的最後一行
+            continue
+
+def iter_records_at(f):
+    # 二進位檔：產生 (紀錄, 行起點, 行結尾)
+    pos = f.tell()
+    for line in f:
+        start = pos
+        pos += len(line)
+        try:
+            yield json.loads(line), start, pos
+        except ValueError:
+            continue
+
+def read_record_text(f, offset):
+    # 讀回 offset 處的 add 或 edit 紀錄中的文字
+    f.seek(offset)
+    record = json.loads(f.readline())
+    if record.get("op") == "add":
+        return record["msg"].get("text", "")
+    return record.get("text", "")
+
+def iter_lines_reverse(f, end):
+    # 從 end 往檔頭逐行產生 (行內容, 行起點)，只讀取實際需要的區塊
+    pos = end
+    tail = b""
+    while pos > 0:
+        size = min(REVERSE_READ_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size) + tail
+        lines = block.split(b"\n")
+        # 第一段可能還沒讀完整，留待下一輪
+        tail = lines[0]
+        offset = pos + len(tail) + 1
+        complete = []
+        for line in lines[1:]:
+            complete.append((line, offset))
+            offset += len(line) + 1
+        for line, start in reversed(complete):
+            if line.strip():
+                yield line, start
+    if tail.strip():
+        yield tail, 0
+
+class JournalStore:
+    # 只追加的訊息日誌（JSON Lines）：新增訊息寫入 add，編輯寫入 edit，刪除寫入 delete 墓碑，
+    # 每次操作的成本只跟該筆訊息有關，不必重寫整份歷史。
+    # 啟動時由檔尾往前只讀最近幾頁；搜尋索引與壓縮用的統計在背景執行緒完整重播後才可用。
+    def __init__(self, path, legacy_path=None, attachments=None):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.attachments = attachments
+        self.inline_blobs = 0        # 日誌中仍內嵌 base64 附件的紀錄數，大於 0 時關閉前壓縮
+        self.live_count = 0
+        self.dead_count = 0
+        self.file = None
+        self.lock = threading.Lock()
+        self.index = None            # 背景建立完成前為 None
+        self.scan_pos = None         # 往前分頁讀取時，尚未讀取部分的結尾位置
+        self.pending_edits = {}      # 往前讀取時先遇到的編輯（較新），等遇到該訊息時套用
+        self.pending_deletes = {}    # 往前讀取時先遇到的刪除墓碑數
+
+    def prepare(self):
+        if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+            self.migrate_legacy()
+        if self.file is None:
+            self.open_append()
+
+    def open_append(self):
+        # 上次寫到一半中斷時檔尾沒有換行；先補上，新紀錄才不會接在殘缺的那一行後面一起被丟掉
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+            if torn:
+                with open(self.path, "ab") as f:
+                    f.write(b"\n")
+        self.file = open(self.path, "ab")
+
+    def load_recent(self, limit):
+        self.prepare()
+        self.scan_pos = os.path.getsize(self.path)
+        threading.Thread(target=self.build_index, args=(self.scan_pos,), daemon=True).start()
+        return self.load_older(limit)
+
+    def load_older(self, limit):
+        # 從 scan_pos 往前讀，湊滿 limit 則仍有效的訊息（由舊到新排列）
+        messages = []
+        if not self.scan_pos:
+            return messages
+        with open(self.path, "rb") as f:
+            for line, start in iter_lines_reverse(f, self.scan_pos):
+                self.scan_pos = start
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                msg = self.apply_reverse(record, start)
+                if msg is not None:
+                    messages.append(msg)
+                    if len(messages) >= limit:
+                        break
+            else:
+                self.scan_pos = 0
+        messages.reverse()
+        return messages
+
+    def apply_reverse(self, record, start):
+        # 倒著重播：編輯與刪除一定比對應的新增先遇到；回傳仍有效的訊息
+        op = record.get("op")
+        if op == "edit":
+            self.pending_edits.setdefault(record["msg_id"], record["text"])
+        elif op == "delete":
+            msg_id = record["msg_id"]
+            self.pending_deletes[msg_id] = self.pending_deletes.get(msg_id, 0) + 1
+        elif op == "add":
+            msg = record["msg"]
+            deleted, text = self.take_pending(msg["msg_id"])
+            if not isinstance(msg["msg_id"], str):
+                # 舊紀錄：換成唯一編號後，再套用以新編號寫入的編輯／刪除（一定比數字編號的紀錄新）
+                msg["legacy_id"] = msg["msg_id"]
+                msg["msg_id"] = legacy_message_id(start)
+                new_deleted, new_text = self.take_pending(msg["msg_id"])
+                deleted = deleted or new_deleted
+                if new_text is not None:
+                    text = new_text
+            if deleted:
+                return None
+            if text is not None:
+                msg["text"] = text
+            if self.attachments:
+                self.attachments.externalize(msg)
+            return msg
+        return None
+
+    def take_pending(self, msg_id):
+        # 取出較新的刪除／編輯，回傳 (是否已刪除, 最新的文字或 None)
+        if self.pending_deletes.get(msg_id):
+            self.pending_deletes[msg_id] -= 1
+            self.pending_edits.pop(msg_id, None)
+            return True, None
+        return False, self.pending_edits.pop(msg_id, None)
+
+    def replay(self):
+        # 正向重播整份日誌；舊紀錄的數字編號換成唯一編號，壓縮後的快照直接保存新編號
+        messages = []
+        positions = {}  # msg_id -> 仍有效的訊息在 messages 中的位置
+        legacy = LegacyIds()
+        total = 0
+        if not os.path.exists(self.path):
+            return messages
+        with open(self.path, "rb") as f:
+            for record, start, _ in iter_records_at(f):
+                total += 1
+                op = record.get("op")
+                if op == "add":
+                    msg = record["msg"]
+                    positions[legacy.assign(msg, start)] = len(messages)
+                    messages.append(msg)
+                elif op == "edit":
+                    idx = positions.get(legacy.resolve(record["msg_id"]))
+                    if idx is not None:
+                        messages[idx]["text"] = record["text"]
+                elif op == "delete":
+                    idx = positions.pop(legacy.resolve(record["msg_id"], remove=True), None)
+                    if idx is not None:
+                        messages[idx] = None
+        messages = [m for m in messages if m is not None]
+        self.live_count = len(messages)
+        self.dead_count = total - len(messages)
+        return messages
+
+    def build_index(self, end):
+        index = SearchIndex()
+        total = 0
+        inline_blobs = 0
+        try:
+            with open(self.path, "rb") as f:
+                for record, start, stop in iter_records_at(f):
+                    total += 1
+                    if record.get("op") == "add" and record["msg"].get("file_data"):
+                        inline_blobs += 1
+                    index.apply_record(record, start)
+                    if stop >= end:
+                        break
+                # 建立期間新寫入的紀錄，在鎖內補上後再啟用索引，之後的寫入直接更新索引
+                with self.lock:
+                    for record, start, stop in iter_records_at(f):
+                        total += 1
+                        index.apply_record(record, start)
+                    self.live_count = index.live
+                    self.dead_count = total - self.live_count
+                    self.inline_blobs = inline_blobs
+                    self.index = index
+            print(f"搜尋索引建立完成，共 {self.live_count} 則訊息")
+        except Exception as e:
+            print("建立搜尋索引失敗:", e)
+
+    def search(self, keyword, limit):
+        # 索引還在背景建立時回傳 None，由呼叫端顯示「建立中」
+        with self.lock:
+            if self.index is None:
+                return None
+            with open(self.path, "rb") as f:
+                return self.index.search(keyword, limit, lambda offset: read_record_text(f, offset))
+
+    def migrate_legacy(self):
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                saved_msgs = json.load(f)
+        except Exception as e:
+            print("讀取舊紀錄失敗:", e)
+            return
+        self.write_snapshot(assign_legacy_ids(saved_msgs))
+        print("已將舊紀錄轉換為日誌格式:", self.path)
+
+    def write_snapshot(self, messages):
+        if self.attachments:
+            for msg in messages:
+                self.attachments.externalize(msg)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for msg in messages:
+                f.write(json.dumps({"op": "add", "msg": msg}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def write_record(self, record):
+        self.write_records([record])
+
+    def write_records(self, records):
+        # 多筆紀錄合併成一次寫入與 flush
+        with self.lock:
+            if self.file is None:
+                self.open_append()
+            lines = [(json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8") for record in records]
+            offset = self.file.tell()
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            if self.index is not None:
+                for record, line in zip(records, lines):
+                    self.index.apply_record(record, offset)
+                    offset += len(line)
+
+    def append(self, msg):
+        self.write_record({"op": "add", "msg": msg})
+        self.live_count += 1
+
+    def append_many(self, msgs):
+        self.write_records([{"op": "add", "msg": msg} for msg in msgs])
+        self.live_count += len(msgs)
+
+    def update_text(self, msg_id, text):
+        self.write_record({"op": "edit", "msg_id": msg_id, "text": text})
+        self.dead_count += 1
+
+    def delete(self, msg_id):
+        self.write_record({"op": "delete", "msg_id": msg_id})
+        self.live_count -= 1
+        self.dead_count += 2
+
+    def needs_compaction(self):
+        # 統計要等背景重播完成才準確
+        if self.index is None:
+            return False
+        if self.attachments and self.inline_blobs:
+            return True
+        return self.dead_count >= COMPACT_MIN_DEAD and self.dead_count > self.live_count
+
+    def compact(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            messages = self.replay()
+            self.write_snapshot(messages)
+            self.index = None  # 紀錄位置已改變
+            self.dead_count = 0
+            self.inline_blobs = 0
+        print("已壓縮訊息日誌:", self.path)
+
+    def close(self):
+        try:
+            if self.needs_compaction():
+                self.compact()
+        except Exception as e:
+            print("壓縮訊息日誌失敗:", e)
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def read_legacy_messages(journal_path=None, legacy_path=None):
+    # 切換到 SQLite 時匯入既有紀錄：優先使用日誌，其次是舊版 messages.json
+    if journal_path and os.path.exists(journal_path):
+        return JournalStore(journal_path).replay()
+    if legacy_path and os.path.exists(legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            return assign_legacy_ids(json.load(f))
+    return []
+
+class SQLiteStore:
+    # SQLite（WAL 模式）訊息庫：msg_id、日期、傳送者都有索引，刪除與查詢不必線性掃描
+    def __init__(self, path, journal_path=None, legacy_path=None, attachments=None):
+        self.path = path
+        self.attachments = attachments
+        self.journal_path = journal_path
+        self.legacy_path = legacy_path
+        self.conn = None
+        self.has_fts = False
+        self.oldest_seq = None  # 已載入訊息中最舊的一筆，往前分頁由此繼續
+
+    def open(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # msg_id 不指定型別，保留原本的數字或字串
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                msg_id NOT NULL,
+                date TEXT,
+                sender_name TEXT,
+                text TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_msg_id ON messages(msg_id);
+            CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date, seq);
+            CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_name, seq);
+        """)
+        self.open_fts()
+
+    def open_fts(self):
+        # FTS5 trigram 全文索引（外部內容表，由觸發器同步）；不支援時退回 LIKE 查詢
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        try:
+            with self.conn:
+                self.conn.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                        USING fts5(text, content='messages', content_rowid='seq', tokenize='trigram');
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.seq, new.text);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.seq, old.text);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.seq, old.text);
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.seq, new.text);
+                    END;
+                """)
+                if not exists:
+                    self.conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            print("不支援 FTS5 全文索引，改用一般查詢:", e)
+
+    def load_recent(self, limit):
+        self.open()
+        if self.conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None:
+            self.migrate_legacy()
+        self.migrate_numeric_ids()
+        rows = self.conn.execute("SELECT seq, data, text FROM messages ORDER BY seq DESC LIMIT ?",
+                                 (limit,)).fetchall()
+        return self.page_from_rows(rows)
+
+    def load_older(self, limit):
+        if self.oldest_seq is None:
+            return []
+        rows = self.conn.execute("SELECT seq, data, text FROM messages WHERE seq < ? ORDER BY seq DESC LIMIT ?",
+                                 (self.oldest_seq, limit)).fetchall()
+        return self.page_from_rows(rows)
+
+    def page_from_rows(self, rows):
+        # rows 由新到舊；回傳由舊到新
+        if rows:
+            self.oldest_seq = rows[-1][0]
+        else:
+            self.oldest_seq = None
+        messages = []
+        for seq, data, text in reversed(rows):
+            msg = self.row_to_message(data, text)
+            # 舊資料內嵌的附件在第一次讀到時移到附件庫
+            if self.attachments and self.attachments.externalize(msg):
+                with self.conn:
+                    self.conn.execute("UPDATE messages SET data = ? WHERE seq = ?",
+                                      (self.message_to_row(msg)[4], seq))
+            messages.append(msg)
+        return messages
+
+    def migrate_legacy(self):
+        try:
+            messages = read_legacy_messages(self.journal_path, self.legacy_path)
+        except Exception as e:
+            print("讀取舊紀錄失敗:", e)
+            return
+        if not messages:
+            return
+        if self.attachments:
+            for msg in messages:
+                self.attachments.externalize(msg)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (msg_id, date, sender_name, text, data) VALUES (?, ?, ?, ?, ?)",
+                [self.message_to_row(m) for m in messages])
+        print(f"已匯入 {len(messages)} 筆舊紀錄至", self.path)
+
+    def migrate_numeric_ids(self):
+        # 之前匯入的舊紀錄可能還是重複的數字編號；換成唯一編號（數字排在文字前面，可用索引查詢）
+        rows = self.conn.execute("SELECT seq, data, text FROM messages WHERE msg_id < ''").fetchall()
+        if not rows:
+            return
+        updates = []
+        for seq, data, text in rows:
+            msg = self.row_to_message(data, text)
+            msg["legacy_id"] = msg["msg_id"]
+            msg["msg_id"] = legacy_message_id(f"db{seq}")
+            row = self.message_to_row(msg)
+            updates.append((row[0], row[4], seq))
+        with self.conn:
+            self.conn.executemany("UPDATE messages SET msg_id = ?, data = ? WHERE seq = ?", updates)
+        print(f"已將 {len(rows)} 筆舊紀錄換成唯一編號")
+
+    def message_to_row(self, msg):
+        # text 另存一欄供編輯與查詢，其餘欄位以 JSON 保存
+        data = {k: v for k, v in msg.items() if k != "text"}
+        return (msg["msg_id"], msg.get("date"), msg.get("sender_name"), msg.get("text", ""),
+                json.dumps(data, ensure_ascii=False))
+
+    def row_to_message(self, data, text):
+        msg = json.loads(data)
+        msg["text"] = text
+        return msg
+
+    def latest_seq(self, msg_id):
+        row = self.conn.execute("SELECT seq FROM messages WHERE msg_id = ? ORDER BY seq DESC LIMIT 1",
+                                (msg_id,)).fetchone()
+        return row[0] if row else None
+
+    def append(self, msg):
+        self.append_many([msg])
+
+    def append_many(self, msgs):
+        # 同一個交易內寫入，一批只 commit 一次
+        self.open()
+        with self.conn:
+            self.conn.executemany("INSERT INTO messages (msg_id, date, sender_name, text, data) VALUES (?, ?, ?, ?, ?)",
+                                  [self.message_to_row(msg) for msg in msgs])
+
+    def update_text(self, msg_id, text):
+        self.open()
+        with self.conn:
+            seq = self.latest_seq(msg_id)
+            if seq is not None:
+                self.conn.execute("UPDATE messages SET text = ? WHERE seq = ?", (text, seq))
+
+    def delete(self, msg_id):
+        self.open()
+        with self.conn:
+            seq = self.latest_seq(msg_id)
+            if seq is not None:
+                self.conn.execute("DELETE FROM messages WHERE seq = ?", (seq,))
+
+    def search(self, keyword, limit):
+        self.open()
+        # trigram 需要至少 3 個字元，較短的關鍵字直接比對（LIMIT 讓最新的結果先回來）
+        if self.has_fts and len(keyword) >= 3:
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            rows = self.conn.execute(
+                "SELECT m.msg_id, m.text FROM messages_fts f JOIN messages m ON m.seq = f.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY f.rowid DESC LIMIT ?", (phrase, limit))
+        else:
+            pattern = "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = self.conn.execute(
+                "SELECT msg_id, text FROM messages WHERE text LIKE ? ESCAPE '\\' ORDER BY seq DESC LIMIT ?",
+                (pattern, limit))
+        return [(msg_id, snippet(text)) for msg_id, text in rows]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,425 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_CHUNK_SIZE = 65536   # 舊版送出端沒有 chunk_size 欄位時的分塊大小
+HASH_READ_SIZE = 1024 * 1024
+DIGEST_SIZE = 32             # 每塊的 SHA-256
+# 上傳分塊大小依檔案大小調整：小檔維持 64KB，大檔放大分塊以減少訊框與系統呼叫數量；
+# 上限避免單一分塊佔住連線太久，也遠低於伺服器的訊框上限
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+TARGET_CHUNKS = 256
+STATE_SAVE_CHUNKS = 32       # 每收到幾塊就把接收進度寫回磁碟
+# 分塊數與分塊大小來自網路，建立接收狀態（每塊一個旗標、預先開檔）前先檢查上限
+MAX_TRANSFER_BYTES = 16 * 1024 * 1024 * 1024
+MAX_TRANSFER_CHUNKS = MAX_TRANSFER_BYTES // MIN_CHUNK_SIZE
+BLOB_PREFIX = "blob-"        # 從伺服器附件庫下載時的 file_id 為 blob-<內容雜湊>
+# 檔案傳輸訊息與文字模式下 payload 所在的欄位
+TRANSFER_PAYLOAD_FIELDS = {"file_chunk": "data", "file_manifest": "chunk_hashes", "file_status": None,
+                           "file_get": None, "file_sync": None}
+TRANSFER_MARKERS = tuple(f'"{kind}"' for kind in TRANSFER_PAYLOAD_FIELDS)
+TRANSFER_MARKERS_BYTES = tuple(marker.encode("ascii") for marker in TRANSFER_MARKERS)
+
+def choose_chunk_size(file_size):
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and chunk_size * TARGET_CHUNKS < file_size:
+        chunk_size *= 2
+    return chunk_size
+
+def build_manifest(path, chunk_size, should_stop=None, copy_path=None):
+    # 逐塊計算 SHA-256，回傳 (串接在一起的 digest bytes, 整個檔案的 SHA-256)；
+    # 給了 copy_path 就在同一次讀取中順便複製；should_stop() 為真時提早結束並回傳 None
+    digests = bytearray()
+    whole = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    copy = open(copy_path, "wb") if copy_path else None
+    try:
+        with open(path, "rb") as f, memoryview(buffer) as view:
+            while True:
+                if should_stop and should_stop():
+                    return None
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                digests += hashlib.sha256(view[:n]).digest()
+                whole.update(view[:n])
+                if copy:
+                    copy.write(view[:n])
+    finally:
+        if copy:
+            copy.close()
+    if not digests:
+        digests += hashlib.sha256(b"").digest()  # 空檔案也算一塊
+    return bytes(digests), whole.hexdigest()
+
+def chunk_count(file_size, chunk_size):
+    return max(1, (file_size + chunk_size - 1) // chunk_size)
+
+def transfer_shape_valid(total_chunks, chunk_size, file_size=None):
+    if not 0 < total_chunks <= MAX_TRANSFER_CHUNKS or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        return False
+    if (total_chunks - 1) * chunk_size >= MAX_TRANSFER_BYTES:
+        return False
+    if file_size is not None and chunk_count(file_size, chunk_size) != total_chunks:
+        return False
+    return True
+
+def blob_file_id(file_hash):
+    return BLOB_PREFIX + file_hash
+
+def parse_transfer_message(meta):
+    # meta 可為 bytes 或 str；回傳 (msg, 種類)，不是檔案傳輸訊息時回傳 (None, None)
+    markers = TRANSFER_MARKERS_BYTES if isinstance(meta, (bytes, bytearray)) else TRANSFER_MARKERS
+    if not any(marker in meta for marker in markers):
+        return None, None
+    try:
+        msg = json.loads(meta)
+    except ValueError:
+        return None, None
+    if not isinstance(msg, dict):
+        return None, None
+    if msg.get("file_chunk"):
+        return msg, "file_chunk"
+    if msg.get("type") in TRANSFER_PAYLOAD_FIELDS:
+        return msg, msg["type"]
+    return None, None
+
+def pop_text_payload(kind, msg):
+    # 文字模式下 payload 以 base64 放在欄位裡
+    field = TRANSFER_PAYLOAD_FIELDS[kind]
+    return base64.b64decode(msg.pop(field, None) or "") if field else b""
+
+def manifest_file_id(file_size, chunk_size, digests):
+    # 相同內容、相同分塊方式得到相同 file_id，斷線重傳時接收端能接續先前的進度
+    seed = f"{file_size}:{chunk_size}:".encode("ascii") + digests
+    return hashlib.sha256(seed).hexdigest()[:32]
+
+def missing_ranges(received):
+    # 把接收旗標壓縮成 [[起點, 終點), ...]
+    ranges = []
+    start = None
+    for i, flag in enumerate(received):
+        if not flag and start is None:
+            start = i
+        elif flag and start is not None:
+            ranges.append([start, i])
+            start = None
+    if start is not None:
+        ranges.append([start, len(received)])
+    return ranges
+
+def ranges_to_indices(ranges, total_chunks):
+    indices = set()
+    for r in ranges:
+        try:
+            start, end = int(r[0]), int(r[1])
+        except (TypeError, ValueError, IndexError):
+            continue
+        indices.update(range(max(0, start), min(end, total_chunks)))
+    return indices
+
+class IncomingFile:
+    # 一個正在接收的分塊檔案：每塊依 chunk_index * chunk_size 直接寫到 .part 檔，到達順序不拘
+    # 有 manifest 時每塊都先比對雜湊；接收進度存在同名的 .json，重新連線後可接續
+    def __init__(self, file_id, total_chunks, chunk_size, file_name, part_path,
+                 file_size=None, digests=None, received=None):
+        self.file_id = file_id
+        self.total_chunks = total_chunks
+        self.chunk_size = chunk_size
+        self.file_name = file_name
+        self.part_path = part_path
+        self.state_path = part_path + ".json"
+        self.file_size = file_size
+        self.digests = digests
+        self.received = received if received is not None else bytearray(total_chunks)  # 每塊一個旗標
+        self.received_count = sum(self.received)
+        self.unsaved = 0
+        resume = received is not None and os.path.exists(part_path)
+        self.file = open(part_path, "r+b" if resume else "wb")
+        if not resume:
+            self.received = bytearray(total_chunks)
+            self.received_count = 0
+
+    @classmethod
+    def restore(cls, state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        digests = bytes.fromhex(state["digests"]) if state.get("digests") else None
+        received = bytearray(base64.b64decode(state["received"]))
+        return cls(state["file_id"], state["total_chunks"], state["chunk_size"], state["file_name"],
+                   state_path[:-len(".json")], state.get("file_size"), digests, received)
+
+    def save_state(self):
+        self.file.flush()  # 標記為已收到之前，資料必須先寫進檔案
+        state = {
+            "file_id": self.file_id,
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "chunk_size": self.chunk_size,
+            "total_chunks": self.total_chunks,
+            "digests": self.digests.hex() if self.digests else None,
+            "received": base64.b64encode(bytes(self.received)).decode("ascii")
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+        self.unsaved = 0
+
+    def chunk_valid(self, index, data):
+        if self.digests is None:
+            return True
+        expected = self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+        return hashlib.sha256(data).digest() == expected
+
+    def write_chunk(self, index, data):
+        # 回傳是否為新收到的分塊；重送的分塊直接忽略，雜湊不符的分塊丟棄等待重送
+        if self.received[index]:
+            return False
+        if not self.chunk_valid(index, data):
+            print(f"分塊雜湊不符，等待重送: {self.file_name} #{index}")
+            return False
+        self.file.seek(index * self.chunk_size)
+        self.file.write(data)
+        self.received[index] = 1
+        self.received_count += 1
+        self.unsaved += 1
+        if self.unsaved >= STATE_SAVE_CHUNKS:
+            self.save_state()
+        return True
+
+    def complete(self):
+        return self.received_count == self.total_chunks
+
+    def size(self):
+        self.file.flush()
+        return os.path.getsize(self.part_path)
+
+    def status(self):
+        return {"type": "file_status", "file_id": self.file_id, "missing": missing_ranges(self.received)}
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+        self.close()
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+class ChunkReceiver:
+    # 接收大檔分塊，全部到齊後以內容雜湊收進附件庫
+    # 未完成的傳輸保留在 attachments/.part-*，下次收到同一個 file_id 的 manifest 或分塊時才從磁碟載回來接續
+    # require_manifest 為真時（伺服器）不接受沒有 manifest 的分塊，每塊都必須通過雜湊驗證
+    def __init__(self, attachments, require_manifest=False):
+        self.attachments = attachments
+        self.require_manifest = require_manifest
+        self.lock = threading.Lock()  # 接收執行緒寫入、Tk 執行緒查詢進度
+        self.transfers = {}  # file_id -> IncomingFile
+        self.completed = {}  # file_id -> 完成的檔案資訊，重送 manifest 時直接回報已完成
+
+    def load(self, file_id):
+        transfer = self.transfers.get(file_id)
+        if transfer is not None:
+            return transfer
+        state_path = self.part_path(file_id) + ".json"
+        if not os.path.exists(state_path):
+            return None
+        try:
+            transfer = IncomingFile.restore(state_path)
+        except Exception as e:
+            print("讀取未完成的傳輸失敗:", file_id, e)
+            return None
+        if transfer.file_id != file_id:
+            transfer.close()
+            return None
+        self.transfers[file_id] = transfer
+        return transfer
+
+    def part_path(self, file_id):
+        # file_id 來自網路，不直接當檔名
+        name = hashlib.sha256(file_id.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.attachments.directory, f".part-{name}")
+
+    def add_manifest(self, msg, digests):
+        # 回傳要回覆給送出端的 file_status
+        with self.lock:
+            return self._add_manifest(msg, digests)
+
+    def _add_manifest(self, msg, digests):
+        file_id = str(msg.get("file_id") or "")
+        try:
+            total = int(msg["total_chunks"])
+            chunk_size = int(msg["chunk_size"])
+            file_size = int(msg["file_size"])
+        except (KeyError, TypeError, ValueError):
+            print("manifest 格式錯誤:", file_id)
+            return None
+        if not file_id or not transfer_shape_valid(total, chunk_size, file_size) \
+                or len(digests) != total * DIGEST_SIZE:
+            print("manifest 格式錯誤:", file_id)
+            return None
+        if file_id in self.completed or (msg.get("file_hash") and self.attachments.find(str(msg["file_hash"]))):
+            # 已經有相同內容的檔案，整個上傳都可以省略
+            return {"type": "file_status", "file_id": file_id, "missing": []}
+        transfer = self.load(file_id)
+        if transfer is not None and (transfer.total_chunks != total or transfer.chunk_size != chunk_size
+                                     or transfer.digests != digests):
+            self.transfers.pop(file_id).remove()
+            transfer = None
+        if transfer is None:
+            transfer = IncomingFile(file_id, total, chunk_size, msg.get("file_name") or file_id,
+                                    self.part_path(file_id), file_size, digests)
+            self.transfers[file_id] = transfer
+        transfer.save_state()
+        return transfer.status()
+
+    def add_chunk(self, msg, data):
+        # 回傳完成的檔案資訊 dict；尚未完成或分塊不合法時回傳 None
+        with self.lock:
+            return self._add_chunk(msg, data)
+
+    def _add_chunk(self, msg, data):
+        file_id = str(msg.get("file_id") or "")
+        try:
+            index = int(msg["chunk_index"])
+            total = int(msg["total_chunks"])
+            chunk_size = int(msg.get("chunk_size") or DEFAULT_CHUNK_SIZE)
+        except (KeyError, TypeError, ValueError):
+            print("分塊格式錯誤:", file_id)
+            return None
+        if not file_id or not transfer_shape_valid(total, chunk_size) or not 0 <= index < total \
+                or len(data) > chunk_size:
+            print("分塊格式錯誤:", file_id)
+            return None
+        if file_id in self.completed:
+            return None
+        transfer = self.load(file_id)
+        if self.require_manifest and (transfer is None or transfer.digests is None
+                                      or transfer.total_chunks != total or transfer.chunk_size != chunk_size):
+            print("沒有對應 manifest 的分塊，丟棄:", file_id)
+            return None
+        if transfer is None or transfer.total_chunks != total or transfer.chunk_size != chunk_size:
+            if transfer is not None:
+                self.transfers.pop(file_id).remove()
+            # 舊版送出端沒有 manifest，只能不驗證地接收
+            transfer = IncomingFile(file_id, total, chunk_size, msg.get("file_name") or file_id,
+                                    self.part_path(file_id))
+            self.transfers[file_id] = transfer
+        transfer.write_chunk(index, data)
+        if not transfer.complete():
+            return None
+        del self.transfers[file_id]
+        info = self.finish(transfer)
+        self.completed[file_id] = info
+        return info
+
+    def status(self, file_id):
+        with self.lock:
+            if file_id in self.completed:
+                return {"type": "file_status", "file_id": file_id, "missing": []}
+            transfer = self.load(file_id)
+            return transfer.status() if transfer else None
+
+    def finish(self, transfer):
+        file_size = transfer.size()
+        transfer.close()
+        digest = hashlib.sha256()
+        with open(transfer.part_path, "rb") as f:
+            while True:
+                block = f.read(HASH_READ_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+        file_hash = digest.hexdigest()
+        self.attachments.commit_temp(transfer.part_path, file_hash)
+        if os.path.exists(transfer.state_path):
+            os.remove(transfer.state_path)
+        return {
+            "file_id": transfer.file_id,
+            "file_name": transfer.file_name,
+            "file_hash": file_hash,
+            "file_size": file_size
+        }
+
+    def discard(self, file_id):
+        with self.lock:
+            transfer = self.transfers.pop(file_id, None)
+            if transfer is not None:
+                transfer.remove()
+
+    def release(self, file_ids):
+        # 上傳者離線：進度寫回磁碟、關閉檔案並移出記憶體，下次 manifest 到達時再載入
+        with self.lock:
+            for file_id in file_ids:
+                transfer = self.transfers.pop(file_id, None)
+                if transfer is None:
+                    continue
+                try:
+                    transfer.save_state()
+                except Exception as e:
+                    print("儲存傳輸進度失敗:", e)
+                transfer.close()
+
+    def close(self):
+        # 連線中斷時保留進度，下次可續傳
+        with self.lock:
+            file_ids = list(self.transfers)
+        self.release(file_ids)
+
+    def expire(self, max_age):
+        # 刪除超過 max_age 秒沒有進展、也不在記憶體中的未完成傳輸
+        now = time.time()
+        with self.lock:
+            active = {transfer.part_path for transfer in self.transfers.values()}
+            for name in os.listdir(self.attachments.directory):
+                if not name.startswith(".part-"):
+                    continue
+                path = os.path.join(self.attachments.directory, name)
+                part_path = path[:-len(".json")] if name.endswith(".json") else path
+                if part_path in active:
+                    continue
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+class StatusCollector:
+    # 上傳端等待各接收端回報 file_status；接收執行緒呼叫 add，上傳執行緒呼叫 wait
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrived = threading.Condition(self.lock)
+        self.statuses = {}  # file_id -> [status, ...]，只收集已登記的 file_id
+
+    def register(self, file_id):
+        with self.lock:
+            self.statuses[file_id] = []
+
+    def unregister(self, file_id):
+        with self.lock:
+            self.statuses.pop(file_id, None)
+
+    def add(self, msg):
+        with self.lock:
+            bucket = self.statuses.get(msg.get("file_id"))
+            if bucket is not None:
+                bucket.append(msg)
+                self.arrived.notify_all()
+
+    def wait(self, file_id, timeout, expected=None):
+        # 回傳收到的 status 列表；知道會有幾個回覆（只有伺服器回覆）時收齊就立刻回傳，
+        # 否則（點對點，接收端數量未知）在 timeout 內盡量收集
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                bucket = self.statuses.get(file_id, [])
+                remaining = deadline - time.monotonic()
+                if (expected is not None and len(bucket) >= expected) or remaining <= 0:
+                    return list(bucket)
+                self.arrived.wait(remaining)